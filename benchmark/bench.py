@@ -44,6 +44,9 @@ URLS_APIFY = [
     'http://localhost:8001/apify?url=https://people.sc.fsu.edu/~jburkardt/data/csv/snakes_count_10000.csv'
 ]
 
+# large pages, to measure JSON serialization (cf JSON_SERIALIZER)
+API_QUERIES = ['', '?_size=1000', '?_size=1000&_shape=objects']
+
 
 async def fetch_apify(session, url):
     if ANALYSIS:
@@ -65,8 +68,9 @@ async def main():
         endpoints = await asyncio.gather(*apify_requests)
         api_requests = list()
         for endpoint in endpoints:
-            for _ in range(20):
-                api_requests.append(asyncio.ensure_future(fetch_api(session, endpoint)))
+            for query in API_QUERIES:
+                for _ in range(20):
+                    api_requests.append(asyncio.ensure_future(fetch_api(session, endpoint + query)))
         await asyncio.gather(*api_requests)
     end = time.time()
     print(f"-------------->Time execution : {end - start}<--------------")
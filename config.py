@@ -1,14 +1,90 @@
 DB_ROOT_DIR = './dbs'
 CSV_CACHE_ENABLED = True
+# Number of processes parsing files in the background (ingestion executor)
 MAX_WORKERS = 3
+# Number of parsing jobs allowed to wait for a free worker, above that /apify and /upload return 503
+INGESTION_QUEUE_SIZE = 10
 DEBUG = True
 SENTRY_DSN = None
 FORCE_SSL = False
 # In bytes, cf `sniff_limit` https://agate.readthedocs.io/en/1.6.1/api/table.html#agate.Table.from_csv
 CSV_SNIFF_LIMIT = 4096 * 2
-# In bytes, csvapi will stop downloading files if they reach this size
+# In bytes, maximum size of the sample used to detect the encoding of a CSV file
+# (if the file does not decode with the detected encoding, the whole file is used)
+ENCODING_DETECTION_LIMIT = 1024 * 1024
+# Number of rows used to infer the type of columns (None to use every row,
+# with CSV_STREAMING_PARSE the whole file is then held in memory)
+TYPE_INFERENCE_LIMIT = 1000
+# Stream CSV files into sqlite by batches instead of loading them in an agate.Table,
+# memory usage does not depend on the file size but types are inferred on a sample
+CSV_STREAMING_PARSE = False
+# Start parsing CSV files while they are being downloaded (other files are parsed once downloaded).
+# A parsing worker is busy for the whole download, best used with CSV_STREAMING_PARSE
+PIPELINED_PARSE = False
+# In bytes, csvapi will stop downloading (or receiving uploaded) files if they reach this size
 # Default to 100 Mo
 MAX_FILE_SIZE = 1024 * 1024 * 100
+# In bytes, uploads are written to disk by blocks of this size as they are received
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Uploaded files are stored by a hash of their content: `sha256`, `blake2b`, `md5` or `xxh3`
+# (much faster, requires `pip install xxhash`, but not collision resistant: only if uploads are trusted).
+# sha256 is faster than md5 only on CPUs with SHA extensions (`sha_ni` in /proc/cpuinfo, e.g. Intel since
+# Ice Lake, AMD Zen, ARMv8), it is about twice slower without them: use `blake2b` on those.
+# Files uploaded with the LEGACY_CONTENT_HASHES are still found in the cache: md5 is the hash used by previous
+# versions, set it to [] once their files are gone. Each hash is computed in the same pass over every upload
+CONTENT_HASH = 'sha256'
+LEGACY_CONTENT_HASHES = ['md5']
+# Quart's limit on request bodies (16 Mo by default), uploads are limited by MAX_FILE_SIZE instead
+MAX_CONTENT_LENGTH = None
+# In bytes, maximum size of compressed files (gzip, bz2, xz or zip) once decompressed,
+# MAX_FILE_SIZE being their compressed size. Default to 1 Go
+MAX_DECOMPRESSED_SIZE = 1024 * 1024 * 1024
+# Downloads share a pool of at most DOWNLOAD_POOL_SIZE connections, and are written to disk
+# by blocks of DOWNLOAD_CHUNK_SIZE bytes. Timeouts are in seconds, to connect and between two reads
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_POOL_SIZE = 100
+DOWNLOAD_CONNECT_TIMEOUT = 30
+DOWNLOAD_READ_TIMEOUT = 60
+# Number of idle read connections kept open by sqlite db, and number of dbs with open connections
+SQLITE_POOL_SIZE = 4
+SQLITE_POOL_MAX_DBS = 32
+# Number of dbs whose general and columns infos are kept in memory
+METADATA_CACHE_SIZE = 256
+# Number of filtered row counts (`total` in /api responses) kept in memory
+COUNT_CACHE_SIZE = 1024
+# Number of rows used to extrapolate filtered totals with `_total=estimate`
+TOTAL_ESTIMATE_SAMPLE = 100000
+# Tables with at least this number of rows get indexes on their selective columns at parse time
+# (at most INDEX_MAX_COLUMNS columns)
+INDEX_MIN_ROWS = 10000
+INDEX_MAX_COLUMNS = 8
+# Number of filtered or sorted queries on a column without index before it gets one
+INDEX_ACCESS_THRESHOLD = 20
+# Build a full text (trigram) index of text columns at parse time, for tables of at least INDEX_MIN_ROWS rows:
+# `__contains` filters and `_search` are much faster, but dbs are bigger (about 3 times the size of the text)
+SEARCH_INDEX = True
+# Exports are streamed: rows are fetched by batches of EXPORT_BATCH_SIZE rows,
+# each batch must be fetched within EXPORT_TIME_LIMIT_MS, and chunks of EXPORT_CHUNK_SIZE bytes are sent
+EXPORT_BATCH_SIZE = 1000
+EXPORT_TIME_LIMIT_MS = 10000
+EXPORT_CHUNK_SIZE = 64 * 1024
+# Serializer of /api responses: `orjson` (much faster, requires `pip install orjson`), `json`
+# or `auto` to use orjson if it is installed
+JSON_SERIALIZER = 'auto'
+# In seconds, `Cache-Control: max-age` of /api responses. They have an ETag and a Last-Modified date,
+# clients can check whether they changed (304 Not Modified responses do not query the db)
+HTTP_CACHE_MAX_AGE = 60
+# In-memory cache of /api responses, by dataset and query string (0 bytes to disable it):
+# total size in bytes, maximum number of responses and time to live in seconds.
+# Hits and misses are shown on /stats
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_MAX_ENTRIES = 10000
+RESPONSE_CACHE_TTL = 300
+# Ingestion jobs (`/apify?async=yes`): number of jobs run at the same time, number of jobs waiting
+# to be run (beyond that, 503 errors are returned) and number of jobs whose status is kept in memory
+JOBS_CONCURRENCY = 2
+JOBS_QUEUE_SIZE = 100
+JOBS_HISTORY_SIZE = 1000
 # Set this to an array of hosts to filter out calls by referer (403 returned if no match)
 # It will also match subdomains
 # e.g. REFERRERS_FILTER = ['data.gouv.fr'] will match 'demo.data.gouv.fr'
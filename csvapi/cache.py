@@ -0,0 +1,69 @@
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    In-memory cache keeping at most `maxsize` entries, the least recently used ones are evicted.
+
+    Optionally, entries expire `ttl` seconds after being set and the total size of the entries
+    (as given to `set`) is kept under `max_bytes`. An entry set with a `version` is only returned
+    for this version, e.g. the signature of the db it comes from: outdated entries are dropped.
+    Not thread safe: it is meant to be used from the event loop.
+    """
+
+    def __init__(self, maxsize=128, max_bytes=None, ttl=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (value, size, expiration time, version)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None, version=None):
+        entry = self.entries.get(key)
+        if entry is not None and (entry[3] != version or (entry[2] is not None and entry[2] <= time.monotonic())):
+            self.pop(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def set(self, key, value, size=0, version=None):
+        if self.maxsize <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+        self.pop(key)
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        self.entries[key] = (value, size, expires, version)
+        self.size += size
+        while len(self.entries) > self.maxsize or (self.max_bytes is not None and self.size > self.max_bytes):
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted[1]
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+        self.size -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
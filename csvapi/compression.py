@@ -0,0 +1,96 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import shutil
+import zipfile
+
+# file type (cf `csvapi.parser.detect_type`) -> compression
+COMPRESSIONS = {
+    'application/gzip': 'gzip',
+    'application/x-bzip2': 'bz2',
+    'application/x-xz': 'xz',
+    'application/zip': 'zip',
+}
+# extensions of the files picked in zip archives containing several files
+ZIP_MEMBER_EXTENSIONS = ('.csv', '.tsv', '.txt')
+
+
+class DecompressedFileTooBig(Exception):
+
+    def __init__(self, max_size):
+        super().__init__('Decompressed file too big (max size is %s bytes)' % max_size)
+
+
+def zip_member(archive):
+    '''The file to parse in a zip archive: its only file, or its only CSV file'''
+    names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    if len(names) > 1:
+        names = [name for name in names if os.path.splitext(name)[1].lower() in ZIP_MEMBER_EXTENSIONS]
+    if len(names) != 1:
+        raise Exception('Zip archives must contain a single CSV file')
+    return names[0]
+
+
+class DecompressedFile(io.RawIOBase):
+    """
+    Decompressed content of the (binary) file object `f`, decompressed as it is read.
+    Reading more than `max_size` bytes raises `DecompressedFileTooBig`.
+    Seeking backwards is supported (it decompresses the file again from the start).
+    """
+
+    def __init__(self, f, compression, max_size=None):
+        self.compressed = f
+        self.max_size = max_size
+        self.archive = None
+        if compression == 'gzip':
+            self.stream = gzip.GzipFile(fileobj=f)
+        elif compression == 'bz2':
+            self.stream = bz2.BZ2File(f)
+        elif compression == 'xz':
+            self.stream = lzma.LZMAFile(f)
+        elif compression == 'zip':
+            self.archive = zipfile.ZipFile(f)
+            self.stream = self.archive.open(zip_member(self.archive))
+        else:
+            raise ValueError(f'Unknown compression {compression}')
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        nb_bytes = self.stream.readinto(b)
+        if self.max_size is not None and self.stream.tell() > self.max_size:
+            raise DecompressedFileTooBig(self.max_size)
+        return nb_bytes
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.stream.seek(offset, whence)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def close(self):
+        if not self.closed:
+            self.stream.close()
+            if self.archive is not None:
+                self.archive.close()
+            self.compressed.close()
+        super().close()
+
+
+def open_decompressed(f, compression, mode='r', max_size=None, encoding=None, newline=None):
+    '''Like `open` (read modes only) for the decompressed content of the binary file object `f`'''
+    decompressed = io.BufferedReader(DecompressedFile(f, compression, max_size=max_size))
+    if 'b' in mode:
+        return decompressed
+    return io.TextIOWrapper(decompressed, encoding=encoding, newline=newline)
+
+
+def decompress_file(filepath, compression, dest_path):
+    with open_decompressed(open(filepath, 'rb'), compression, mode='rb') as f, open(dest_path, 'wb') as dest:
+        shutil.copyfileobj(f, dest, 1024 * 1024)
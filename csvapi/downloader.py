@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+# in bytes, data is written to disk by blocks of this size (in a thread, not to block the event loop)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# maximum number of connections open at the same time, by all downloads
+DOWNLOAD_POOL_SIZE = 100
+# in seconds, to connect to a server and between two reads
+DOWNLOAD_CONNECT_TIMEOUT = 30
+DOWNLOAD_READ_TIMEOUT = 60
+
+
+def write_block(f, data):
+    f.write(data)
+    # visible right away to readers of the file being downloaded, cf `csvapi.pipeline`
+    f.flush()
+
+
+class FileTooBig(Exception):
+
+    def __init__(self, max_size):
+        super().__init__('File too big (max size is %s bytes)' % max_size)
+
+
+class Downloader:
+    """
+    Download files to disk through a shared pool of HTTP connections (kept alive between downloads).
+
+    Data is read as soon as it arrives and written by blocks of `chunk_size` bytes in a thread.
+    Files bigger than the maximum size are rejected from their Content-Length when there is one,
+    or as soon as they go over it otherwise. Throughput of downloads is measured, cf `stats`.
+    """
+
+    def __init__(self, chunk_size=DOWNLOAD_CHUNK_SIZE, pool_size=DOWNLOAD_POOL_SIZE,
+                 connect_timeout=DOWNLOAD_CONNECT_TIMEOUT, read_timeout=DOWNLOAD_READ_TIMEOUT):
+        self.chunk_size = chunk_size
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        self.session = None
+        self.downloads = 0
+        self.not_modified = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.seconds = 0
+
+    def get_session(self):
+        # sessions are bound to an event loop, the app may be served by several loops in a row (e.g. in tests)
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session.loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300)
+            # gzipped responses are stored as they are, the parser decompresses them (cf `csvapi.compression`):
+            # fewer bytes written to disk, and MAX_FILE_SIZE applies to the bytes actually transferred
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                raise_for_status=True,
+                auto_decompress=False,
+                headers={'Accept-Encoding': 'gzip'},
+            )
+        return self.session
+
+    async def download(self, url, path, max_size, etag=None, last_modified=None, progress=None):
+        '''
+        Download `url` to `path`, if it has changed since it was fetched with `etag` or `last_modified`.
+
+        Returns a dict with `not_modified` (nothing is written then), the `etag` and `last_modified`
+        headers of the response, the number of `bytes` and the duration (`seconds`) of the download.
+        `progress(bytes, total_bytes)` is called as data is received, `total_bytes` may be None.
+        '''
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        async with self.get_session().get(url, headers=headers) as resp:
+            result = {
+                'not_modified': resp.status == 304,
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+                'bytes': 0,
+            }
+            if result['not_modified']:
+                self.not_modified += 1
+                result['seconds'] = time.perf_counter() - start
+                return result
+            total_bytes = resp.content_length
+            if total_bytes is not None and total_bytes > max_size:
+                self.rejected += 1
+                raise FileTooBig(max_size)
+            if progress:
+                progress(0, total_bytes)
+            with open(path, 'wb') as f:
+                buffer = bytearray()
+                while True:
+                    # whatever has been received, rather than a fixed (small) amount at a time
+                    chunk = await resp.content.readany()
+                    if not chunk:
+                        break
+                    result['bytes'] += len(chunk)
+                    if result['bytes'] > max_size:
+                        self.rejected += 1
+                        raise FileTooBig(max_size)
+                    buffer += chunk
+                    if len(buffer) >= self.chunk_size:
+                        await loop.run_in_executor(None, write_block, f, bytes(buffer))
+                        buffer.clear()
+                    if progress:
+                        progress(result['bytes'], total_bytes)
+                if buffer:
+                    await loop.run_in_executor(None, write_block, f, bytes(buffer))
+        result['seconds'] = time.perf_counter() - start
+        self.downloads += 1
+        self.bytes += result['bytes']
+        self.seconds += result['seconds']
+        log.info('Downloaded %s bytes from %s in %.2fs (%.1f MB/s)', result['bytes'], url, result['seconds'],
+                 result['bytes'] / (result['seconds'] or 1e-9) / 1e6)
+        return result
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def stats(self):
+        return {
+            'downloads': self.downloads,
+            'not_modified': self.not_modified,
+            'rejected': self.rejected,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 3),
+            # bytes per second, over all downloads
+            'throughput': round(self.bytes / self.seconds) if self.seconds else None,
+        }
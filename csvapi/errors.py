@@ -8,6 +8,10 @@ class APIError(Exception):
             self.status = status
         self.payload = payload
 
+    def __reduce__(self):
+        # keep the status and payload when pickled, e.g. raised in an ingestion worker process
+        return (self.__class__, (self.message, self.status, self.payload))
+
     def to_dict(self):
         rv = dict(self.payload or ())
         rv['error'] = self.message
@@ -1,15 +1,242 @@
+import asyncio
 import csv
+import json
+import os
 import sqlite3
 
 from io import StringIO
+from tempfile import NamedTemporaryFile
 from pathlib import Path
 
-from quart import make_response
+from quart import make_response, request, current_app as app
 
 from csvapi.errors import APIError
-from csvapi.tableview import TableView
+from csvapi.tableview import TableView, sqlite_timelimit
 from csvapi.utils import get_db_info
 
+# number of rows fetched from sqlite at once
+EXPORT_BATCH_SIZE = 1000
+# in bytes, approximate size of the chunks of the response
+EXPORT_CHUNK_SIZE = 64 * 1024
+# time limit to fetch a batch of rows, exports as a whole are not limited
+EXPORT_TIME_LIMIT_MS = 10000
+# number of rows by parquet row group, a row group is buffered before being written
+PARQUET_ROW_GROUP_SIZE = 64 * 1024
+# rows in a sheet, header included
+XLSX_MAX_ROWS = 1048576
+# _format: (mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+}
+
+
+async def iter_batches(pool, db_path, sql, params, batch_size, time_limit_ms, logger):
+    """
+    Run `sql` on a pooled connection and yield the column names, then batches of rows.
+    Rows are fetched as they are consumed: memory usage does not depend on the number of rows.
+    """
+    async with pool.connection(db_path) as conn:
+        async with sqlite_timelimit(conn, time_limit_ms):
+            cursor = await conn.execute(sql, params)
+        try:
+            yield [r[0] for r in cursor.description]
+            while True:
+                async with sqlite_timelimit(conn, time_limit_ms):
+                    rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        except sqlite3.OperationalError as e:
+            # the response has already started, it can only be truncated
+            logger.error(f'Export of {db_path} interrupted: {e}')
+        finally:
+            await cursor.close()
+
+
+async def csv_chunks(columns, batches, chunk_size):
+    """Write batches of rows as CSV into a single buffer, flushed every `chunk_size` bytes"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for rows in batches:
+        writer.writerows(rows)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+async def ndjson_chunks(columns, batches, chunk_size):
+    """One JSON object by row"""
+    buffer = StringIO()
+    async for rows in batches:
+        for row in rows:
+            buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+            buffer.write('\n')
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class ChunkSink:
+    """
+    Write-only file object for pyarrow writers: written bytes are kept until they are taken.
+    `tell()` is the total number of bytes written, as parquet needs it for its footer.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_schema(pa, columns, sql_types):
+    types = {'FLOAT': pa.float64(), 'BOOLEAN': pa.bool_()}
+    # dates and times are stored as ISO strings
+    return pa.schema([
+        (column, types.get(sql_type.upper(), pa.string())) for column, sql_type in zip(columns, sql_types)
+    ])
+
+
+def arrow_array(pa, values, arrow_type):
+    """Build an arrow array of `arrow_type`, values which do not fit are converted (or dropped for numbers)"""
+    try:
+        if arrow_type == pa.bool_():
+            # sqlite stores booleans as integers
+            return pa.array(values, type=pa.int64()).cast(pa.bool_())
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        pass
+    if arrow_type == pa.string():
+        return pa.array([None if v is None else str(v) for v in values], type=arrow_type)
+    converted = []
+    for value in values:
+        try:
+            converted.append(None if value is None else float(value))
+        except (TypeError, ValueError):
+            converted.append(None)
+    if arrow_type == pa.bool_():
+        return pa.array(converted, type=pa.float64()).cast(pa.bool_())
+    return pa.array(converted, type=arrow_type)
+
+
+async def arrow_chunks(columns, batches, sql_types, parquet=False):
+    """
+    Arrow IPC stream (a record batch by batch of rows)
+    or parquet file (a row group by PARQUET_ROW_GROUP_SIZE rows).
+    Encoding runs in a thread, not to block the event loop.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    loop = asyncio.get_running_loop()
+    schema = arrow_schema(pa, columns, sql_types)
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema) if parquet else pa.ipc.new_stream(sink, schema)
+
+    def write(rows):
+        batch = pa.RecordBatch.from_arrays(
+            [arrow_array(pa, list(values), field.type) for values, field in zip(zip(*rows), schema)],
+            schema=schema,
+        )
+        if parquet:
+            writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            writer.write_batch(batch)
+        return sink.take()
+
+    group = []
+    async for rows in batches:
+        group += rows
+        if not parquet or len(group) >= PARQUET_ROW_GROUP_SIZE:
+            yield await loop.run_in_executor(None, write, group)
+            group = []
+    if group:
+        yield await loop.run_in_executor(None, write, group)
+    writer.close()
+    yield sink.take()
+
+
+async def write_xlsx(columns, batches, max_rows):
+    """
+    xlsx files are zip archives, they can not be sent before being complete: rows are written
+    to a temporary file (openpyxl write-only mode keeps memory usage constant), returned open and unlinked.
+    The response has not started yet: raise an APIError if there are more than `max_rows` rows.
+    """
+    from openpyxl import Workbook
+
+    loop = asyncio.get_running_loop()
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(columns)
+
+    def append(rows):
+        for row in rows:
+            sheet.append(row)
+
+    def discard():
+        sheet.close()
+        sheet._writer.cleanup()
+
+    tmp = NamedTemporaryFile(suffix='.xlsx', delete=False)
+    tmp.close()
+    try:
+        nb_rows = 0
+        async for rows in batches:
+            nb_rows += len(rows)
+            if nb_rows > max_rows:
+                # removes the temporary file where openpyxl buffers the rows of the sheet
+                await loop.run_in_executor(None, discard)
+                raise APIError(
+                    f'Too many rows for a xlsx export (more than {max_rows}), use filters or another _format.',
+                    status=400
+                )
+            await loop.run_in_executor(None, append, rows)
+        await loop.run_in_executor(None, workbook.save, tmp.name)
+        return open(tmp.name, 'rb')
+    finally:
+        # releases the connection when the export stops early
+        await batches.aclose()
+        os.unlink(tmp.name)
+
+
+async def file_chunks(f, chunk_size):
+    loop = asyncio.get_running_loop()
+    with f:
+        while True:
+            chunk = await loop.run_in_executor(None, f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
 
 class ExportView(TableView):
 
@@ -20,24 +247,57 @@ class ExportView(TableView):
         if not p.exists():
             raise APIError('Database has probably been removed.', status=404)
 
+        validators = self.http_validators(db_info)
+        if self.is_not_modified(*validators):
+            return self.not_modified(*validators)
+
+        _format = request.args.get('_format', 'csv')
+        if _format not in EXPORT_FORMATS:
+            raise APIError(f'Unknown _format: {_format}', status=400)
+        if _format in ('parquet', 'arrow'):
+            try:
+                import pyarrow  # noqa
+            except ImportError:
+                raise APIError(f'{_format} export is not available, pyarrow is not installed.', status=501)
+
+        filters = self.get_filters()
+        sql, params = await self.query(db_info, filters, export=True)
+        batches = iter_batches(
+            app.db_pool,
+            db_info['db_path'],
+            sql,
+            params,
+            app.config.get('EXPORT_BATCH_SIZE', EXPORT_BATCH_SIZE),
+            app.config.get('EXPORT_TIME_LIMIT_MS', EXPORT_TIME_LIMIT_MS),
+            app.logger,
+        )
         try:
-            columns, rows_iter = await self.data(db_info, export=True)
+            # run the query now, so that errors are reported before the response starts
+            columns = await batches.__anext__()
         except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
             raise APIError('Error selecting data', status=400, payload=dict(details=str(e)))
 
-        def make_line(line_data):
-            line = StringIO()
-            writer = csv.writer(line)
-            writer.writerow(line_data)
-            line.seek(0)
-            return line.read().encode()
-
-        async def _make_response():
-            yield make_line(columns)
-            for line in rows_iter:
-                yield make_line(line)
-
-        response = await make_response(_make_response())
-        response.mimetype = 'text/csv'
-        response.headers['Content-Disposition'] = f'attachment; filename={urlhash}.csv'
+        sort_column = request.args.get('_sort') or request.args.get('_sort_desc')
+        if filters or sort_column:
+            await self.track_columns(db_info, filters, sort_column)
+
+        chunk_size = app.config.get('EXPORT_CHUNK_SIZE', EXPORT_CHUNK_SIZE)
+        if _format == 'csv':
+            chunks = csv_chunks(columns, batches, chunk_size)
+        elif _format == 'ndjson':
+            chunks = ndjson_chunks(columns, batches, chunk_size)
+        elif _format == 'xlsx':
+            # the header takes a row of the sheet
+            xlsx_file = await write_xlsx(columns, batches, XLSX_MAX_ROWS - 1)
+            chunks = file_chunks(xlsx_file, chunk_size)
+        else:
+            metadata = await self.metadata(db_info)
+            sql_types = [sql_type for _, sql_type in metadata['columns']]
+            chunks = arrow_chunks(columns, batches, sql_types, parquet=_format == 'parquet')
+
+        mimetype, extension = EXPORT_FORMATS[_format]
+        response = await make_response(chunks)
+        response.mimetype = mimetype
+        response.headers['Content-Disposition'] = f'attachment; filename={urlhash}.{extension}'
+        self.set_http_cache_headers(response, *validators)
         return response
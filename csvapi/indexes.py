@@ -0,0 +1,200 @@
+import logging
+import os
+import shutil
+import sqlite3
+import string
+import tempfile
+
+from csvapi.cache import LRUCache
+from csvapi.singleflight import try_file_lock
+from csvapi.utils import create_connection, get_db_signature, get_hash
+
+log = logging.getLogger(__name__)
+
+# tables smaller than this are scanned fast enough, they do not get indexes
+INDEX_MIN_ROWS = 10000
+# maximum number of columns indexed at parse time
+INDEX_MAX_COLUMNS = 8
+# number of rows used to measure the cardinality of columns
+INDEX_SAMPLE_SIZE = 10000
+# text columns are indexed if they have at least this ratio of distinct values in the sample...
+INDEX_MIN_DISTINCT_RATIO = 0.1
+# ...and if their values are short (codes, identifiers, names rather than free text)
+INDEX_MAX_TEXT_LENGTH = 64
+# comparators (cf `TableView.add_filters_to_sql`) that can use an index
+INDEXABLE_COMPARATORS = ('exact', 'less', 'greater')
+# FTS5 tokenizer of the full text index (requires SQLite >= 3.34),
+# it only matches values of at least 3 characters
+SEARCH_TOKENIZER = 'trigram'
+SEARCH_MIN_LENGTH = 3
+
+
+# columns that are the first column of an index of a table
+INDEXED_COLUMNS_SQL = 'SELECT DISTINCT ii.name FROM pragma_index_list(?) AS il, pragma_index_info(il.name) AS ii ' \
+    'WHERE ii.seqno = 0'
+
+ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def sqlite_lower(name):
+    '''Column name as compared by sqlite, which only folds the case of ASCII letters'''
+    return name.translate(ASCII_LOWER)
+
+
+def index_name(table, column):
+    # sqlite column names are case insensitive
+    return f'{table}_idx_{get_hash(column.lower())[:12]}'
+
+
+def select_index_columns(conn, table, max_columns=INDEX_MAX_COLUMNS, sample_size=INDEX_SAMPLE_SIZE):
+    '''
+    Pick the columns worth an index, from their type and their cardinality in a sample:
+    numbers and dates (range filters, sorts) and short text values that are selective enough.
+    Booleans and constant columns are never indexed.
+    '''
+    columns = [(row[1], (row[2] or '').upper()) for row in conn.execute(f'PRAGMA table_info([{table}])')]
+    if not columns:
+        return []
+    stats = ', '.join(f'COUNT(DISTINCT [{name}]), AVG(LENGTH([{name}]))' for name, _ in columns)
+    row = conn.execute(
+        f'SELECT COUNT(*), {stats} FROM (SELECT * FROM [{table}] LIMIT ?)', (sample_size,)
+    ).fetchone()
+    nb_rows = row[0] or 1
+
+    candidates = []
+    for i, (name, sql_type) in enumerate(columns):
+        distinct, avg_length = row[1 + 2 * i], row[2 + 2 * i]
+        ratio = distinct / nb_rows
+        if sql_type == 'BOOLEAN' or distinct <= 1:
+            continue
+        if sql_type == 'VARCHAR' and (ratio < INDEX_MIN_DISTINCT_RATIO or (avg_length or 0) > INDEX_MAX_TEXT_LENGTH):
+            continue
+        candidates.append((ratio, name))
+    # most selective columns first
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+    return [name for _, name in candidates[:max_columns]]
+
+
+def create_indexes(conn, table, columns):
+    for column in columns:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS [{index_name(table, column)}] ON [{table}] ([{column}])')
+    conn.commit()
+
+
+def search_table(table):
+    return f'{table}_fts'
+
+
+def search_phrase(value):
+    '''FTS5 query matching `value` as a substring, whatever the characters it contains'''
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+def create_search_index(db_path, table, row_count, min_rows=INDEX_MIN_ROWS):
+    '''
+    Build a FTS5 trigram index of the text columns of `table`, used for `__contains` filters and `_search`.
+    It is an external content table: only the index is stored, not another copy of the values.
+    If SQLite lacks FTS5 or the trigram tokenizer, there is no index and filters use LIKE instead.
+    '''
+    if row_count < min_rows:
+        return []
+    conn = create_connection(db_path)
+    try:
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info([{table}])') if row[2].upper() == 'VARCHAR']
+        if not columns:
+            return []
+        fts = search_table(table)
+        conn.execute(f'DROP TABLE IF EXISTS [{fts}]')
+        try:
+            conn.execute(
+                f"CREATE VIRTUAL TABLE [{fts}] USING fts5({', '.join(f'[{c}]' for c in columns)}, "
+                f"content=[{table}], content_rowid=rowid, tokenize='{SEARCH_TOKENIZER}')"
+            )
+        except sqlite3.OperationalError as e:
+            log.warning('No full text index for %s (SQLite %s): %s', table, sqlite3.sqlite_version, e)
+            return []
+        conn.execute(f"INSERT INTO [{fts}] ([{fts}]) VALUES ('rebuild')")
+        conn.commit()
+        return columns
+    finally:
+        conn.close()
+
+
+def index_new_db(db_path, table, row_count, min_rows=INDEX_MIN_ROWS, max_columns=INDEX_MAX_COLUMNS):
+    '''
+    Index the selective columns of a freshly parsed db (cf `select_index_columns`).
+    Runs at ingestion time, before the db is served.
+    '''
+    if row_count < min_rows or not max_columns:
+        return []
+    conn = create_connection(db_path)
+    try:
+        columns = select_index_columns(conn, table, max_columns=max_columns)
+        create_indexes(conn, table, columns)
+        return columns
+    finally:
+        conn.close()
+
+
+def add_indexes(db_path, table, columns, signature):
+    '''
+    Add indexes to a db that is already served.
+
+    Readers open dbs `immutable=1`, so the index is built on a copy which then replaces the db.
+    This holds the lock file of the db used by ingestion (`{storage}/{hash}.lock`), so that the db
+    is not parsed again meanwhile. If the lock is taken (the db is being parsed again) or the db
+    has changed since `signature`, nothing is indexed.
+    '''
+    with try_file_lock(f'{os.path.splitext(db_path)[0]}.lock') as locked:
+        if not locked or get_db_signature(db_path) != signature:
+            log.info('%s changed or is being parsed again, dropping indexes on %s', db_path, columns)
+            return False
+        fd, tmp_path = tempfile.mkstemp(prefix=f'.{os.path.basename(db_path)}.', suffix='.index.tmp',
+                                        dir=os.path.dirname(db_path))
+        os.close(fd)
+        try:
+            shutil.copyfile(db_path, tmp_path)
+            conn = create_connection(tmp_path)
+            try:
+                create_indexes(conn, table, columns)
+            finally:
+                conn.close()
+            os.replace(tmp_path, db_path)
+            return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+class IndexAdvisor:
+    """
+    Track which columns of which dbs are used in indexable filters and sorts,
+    and tell when a column has been used `threshold` times without an index.
+    """
+
+    def __init__(self, threshold=20, maxsize=4096):
+        self.threshold = threshold
+        # (db_path, signature, column) -> number of uses
+        self.uses = LRUCache(maxsize)
+        # indexes being built
+        self.pending = set()
+
+    def record(self, db_path, signature, columns):
+        '''Record the use of `columns` and return the ones which should be indexed now'''
+        to_index = []
+        for column in columns:
+            key = (db_path, signature, column)
+            if key in self.pending:
+                continue
+            uses = self.uses.get(key, 0) + 1
+            self.uses.set(key, uses)
+            if uses >= self.threshold:
+                self.pending.add(key)
+                to_index.append(column)
+        return to_index
+
+    def done(self, db_path, signature, columns):
+        for column in columns:
+            key = (db_path, signature, column)
+            self.pending.discard(key)
+            self.uses.pop(key)
@@ -0,0 +1,211 @@
+import logging
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+import sqlite3
+
+from csv_detective.explore_csv import routine
+
+from csvapi.compression import decompress_file
+from csvapi.indexes import INDEX_MAX_COLUMNS, INDEX_MIN_ROWS, create_search_index, index_new_db
+from csvapi.parser import parse
+from csvapi.profiling import CSVAPIProfileReport
+from csvapi.utils import (
+    check_csv_detective_report_structure,
+    check_profile_report_structure,
+    create_connection,
+    enrich_db_with_metadata,
+    get_db_info,
+    set_db_infos,
+)
+
+log = logging.getLogger(__name__)
+
+# number of rows of each index sampled by ANALYZE
+ANALYSIS_LIMIT = 1000
+
+
+def ingest(filepath, urlhash, storage, encoding=None, sniff_limit=None, analysis=None, streaming=False,
+           encoding_limit=None, type_inference_limit=None, index_min_rows=INDEX_MIN_ROWS,
+           index_max_columns=INDEX_MAX_COLUMNS, search_index=False, max_decompressed_size=None):
+    """
+    Parse `filepath` into `{storage}/{urlhash}.db` and optionally enrich it
+    with csv-detective and pandas-profiling metadata.
+    Selective columns are indexed if the table has at least `index_min_rows` rows,
+    and so are text columns for substring search if `search_index` is set.
+
+    The db is built in a temporary directory of `storage` and finalized (cf `finalize_db`),
+    then atomically renamed to its final path: readers either see the previous version of the db
+    or the complete new one, and nothing is left behind if parsing fails.
+
+    This is CPU bound and meant to run in the ingestion executor
+    (cf `csvapi.utils.run_in_executor`): it must not rely on the app context.
+    """
+    build_dir = new_build_dir(urlhash, storage)
+    try:
+        infos = build_db(
+            filepath,
+            urlhash,
+            build_dir,
+            encoding=encoding,
+            sniff_limit=sniff_limit,
+            streaming=streaming,
+            encoding_limit=encoding_limit,
+            type_inference_limit=type_inference_limit,
+            index_min_rows=index_min_rows,
+            index_max_columns=index_max_columns,
+            search_index=search_index,
+            max_decompressed_size=max_decompressed_size,
+        )
+        if analysis == 'yes':
+            analyse_db(filepath, urlhash, build_dir, infos)
+        swap_db(urlhash, build_dir, storage)
+        return infos
+    finally:
+        discard_build(build_dir)
+
+
+def new_build_dir(urlhash, storage):
+    """Temporary directory where a db is built, in `storage` so that the db can be renamed to its final path"""
+    return tempfile.mkdtemp(prefix=f'.{urlhash}.', suffix='.build', dir=storage)
+
+
+def discard_build(build_dir):
+    shutil.rmtree(build_dir, ignore_errors=True)
+
+
+def build_db(filepath, urlhash, storage, encoding=None, sniff_limit=None, streaming=False, encoding_limit=None,
+             type_inference_limit=None, index_min_rows=INDEX_MIN_ROWS, index_max_columns=INDEX_MAX_COLUMNS,
+             search_index=False, follow=False, max_decompressed_size=None):
+    """
+    Parse and index `filepath` into `{storage}/{urlhash}.db` (cf `ingest`).
+    With `follow`, parsing starts while `filepath` is being downloaded (cf `csvapi.parser.parse`).
+    """
+    infos = parse(
+        filepath,
+        urlhash,
+        storage,
+        encoding=encoding,
+        sniff_limit=sniff_limit,
+        streaming=streaming,
+        encoding_limit=encoding_limit,
+        type_inference_limit=type_inference_limit,
+        follow=follow,
+        max_decompressed_size=max_decompressed_size,
+    )
+    row_count = store_row_count(urlhash, storage)
+    db_info = get_db_info(urlhash, storage=storage)
+    indexed_columns = index_new_db(
+        db_info['db_path'], db_info['table_name'], row_count, min_rows=index_min_rows, max_columns=index_max_columns
+    )
+    if indexed_columns:
+        log.info('Indexed columns %s of %s', indexed_columns, urlhash)
+    if search_index:
+        create_search_index(db_info['db_path'], db_info['table_name'], row_count, min_rows=index_min_rows)
+    return infos
+
+
+def analyse_db(filepath, urlhash, storage, infos):
+    """Enrich `{storage}/{urlhash}.db` with csv-detective and pandas-profiling metadata"""
+    if infos['filetype'] == 'csv':
+        if infos.get('compression'):
+            # csv-detective reads the file by itself
+            with tempfile.NamedTemporaryFile(dir=storage, suffix='.csv', delete=False) as tmp:
+                pass
+            try:
+                decompress_file(filepath, infos['compression'], tmp.name)
+                analyse_db(tmp.name, urlhash, storage, dict(infos, compression=None))
+            finally:
+                os.remove(tmp.name)
+            return
+        # reuse our encoding, csv-detective would otherwise detect it again on the whole file
+        csv_detective_report = routine(filepath, encoding=infos['encoding'])
+        if not check_csv_detective_report_structure(csv_detective_report):
+            log.error('csvdetective report malformed')
+            return
+
+        profile_report = CSVAPIProfileReport().get_minimal_profile(urlhash, storage=storage)
+        if not check_profile_report_structure(profile_report):
+            log.error('pandas profiling report malformed')
+            return
+
+        enrich_db_with_metadata(
+            urlhash,
+            csv_detective_report,
+            profile_report,
+            None,
+            None,
+            storage=storage,
+            encoding_confidence=infos['encoding_confidence'],
+        )
+    else:
+        conn = create_connection(get_db_info(urlhash, storage=storage)['db_path'])
+        general_infos = [
+            {
+                'filetype': 'excel'
+            }
+        ]
+        df = pd.DataFrame(general_infos)
+        df.to_sql('general_infos', con=conn, if_exists='replace', index=False)
+        conn.close()
+
+
+def swap_db(urlhash, build_dir, storage, db_infos=None):
+    """
+    Finalize the db built in `build_dir` and atomically replace `{storage}/{urlhash}.db` with it.
+    `db_infos` are stored in the db, cf `set_db_infos`.
+    """
+    build_path = get_db_info(urlhash, storage=build_dir)['db_path']
+    db_path = get_db_info(urlhash, storage=storage)['db_path']
+    generation = finalize_db(build_path, get_db_generation(db_path) + 1, db_infos=db_infos)
+    os.replace(build_path, db_path)
+    log.info('Swapped in generation %s of %s', generation, urlhash)
+    return generation
+
+
+def get_db_generation(db_path):
+    """Number of times the db has been built, 0 if it does not exist"""
+    if not os.path.exists(db_path):
+        return 0
+    conn = sqlite3.connect(f'file:{db_path}?immutable=1', uri=True)
+    try:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+    except sqlite3.DatabaseError:
+        # e.g. a db left corrupted by a previous version, it is replaced anyway
+        return 0
+    finally:
+        conn.close()
+
+
+def finalize_db(db_path, generation, db_infos=None):
+    """
+    Last writes to a db before it is served: planner statistics, its generation (in `PRAGMA user_version`)
+    and a VACUUM, which drops the free pages left by the build and defragments tables and indexes.
+    """
+    conn = create_connection(db_path)
+    try:
+        # statistics on a sample of each index are enough for the planner, and much faster to build
+        conn.execute(f'PRAGMA analysis_limit = {ANALYSIS_LIMIT}')
+        conn.execute('ANALYZE')
+        conn.execute(f'PRAGMA user_version = {int(generation)}')
+        conn.commit()
+        if db_infos:
+            set_db_infos(conn, **db_infos)
+        conn.execute('VACUUM')
+    finally:
+        conn.close()
+    return generation
+
+
+def store_row_count(urlhash, storage):
+    """Count rows once at ingestion time, so that /api does not have to count the whole table"""
+    db_info = get_db_info(urlhash, storage=storage)
+    conn = create_connection(db_info['db_path'])
+    try:
+        (row_count,) = conn.execute(f"SELECT COUNT(*) FROM [{db_info['table_name']}]").fetchone()
+        set_db_infos(conn, row_count=row_count)
+    finally:
+        conn.close()
+    return row_count
@@ -0,0 +1,129 @@
+import time
+import uuid
+
+from collections import deque
+
+from quart import current_app as app
+
+from csvapi.cache import LRUCache
+from csvapi.errors import APIError
+
+# statuses of a job, in order: a job ends up `done` or `failed`
+JOB_STATUSES = ('queued', 'downloading', 'parsing', 'profiling', 'done', 'failed')
+
+
+class Job:
+    """An ingestion run in the background, polled by clients on /jobs/<id>"""
+
+    def __init__(self, url, urlhash, status='queued'):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.urlhash = urlhash
+        self.status = status
+        self.error = None
+        # downloaded bytes, and total size if the server sent it
+        self.bytes = 0
+        self.total_bytes = None
+        self.created_at = time.time()
+        self.finished_at = self.created_at if self.finished else None
+        # status -> seconds spent in this status
+        self.timings = {}
+        self.status_started = time.monotonic()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def set_status(self, status):
+        now = time.monotonic()
+        self.timings[self.status] = self.timings.get(self.status, 0) + now - self.status_started
+        self.status = status
+        self.status_started = now
+        if self.finished:
+            self.finished_at = time.time()
+
+    def set_progress(self, nb_bytes, total_bytes):
+        self.bytes = nb_bytes
+        self.total_bytes = total_bytes
+
+    def fail(self, error):
+        self.error = error
+        self.set_status('failed')
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'url': self.url,
+            'status': self.status,
+            'error': self.error,
+            'bytes': self.bytes,
+            'total_bytes': self.total_bytes,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'timings': {status: round(seconds, 3) for status, seconds in self.timings.items()},
+        }
+
+
+class JobScheduler:
+    """
+    Run ingestion jobs in the background, at most `concurrency` at a time.
+
+    At most `queue_size` jobs can wait to be run: beyond that, new jobs are refused.
+    A job submitted for a key (e.g. a file) while another one is waiting or running is not run twice,
+    the first one is returned instead. The last `history_size` jobs can be looked up by id.
+    """
+
+    def __init__(self, concurrency=2, queue_size=100, history_size=1000):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.jobs = LRUCache(history_size)
+        # key -> job, for the jobs waiting or running
+        self.active = {}
+        self.queue = deque()
+        self.running = 0
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def add(self, job):
+        '''Keep track of a job without running it, e.g. a job done already'''
+        self.jobs.set(job.id, job)
+        return job
+
+    def submit(self, key, job, func, *args, **kwargs):
+        '''Schedule `func(job, *args, **kwargs)` (a coroutine function) and return the job running it'''
+        active = self.active.get(key)
+        if active is not None:
+            return active
+        if self.running >= self.concurrency and len(self.queue) >= self.queue_size:
+            raise APIError('Too many files being parsed, please retry later.', status=503)
+        self.active[key] = self.add(job)
+        self.queue.append((key, job, func, args, kwargs))
+        self.start_jobs()
+        return job
+
+    def start_jobs(self):
+        while self.running < self.concurrency and self.queue:
+            self.running += 1
+            app.add_background_task(self.run, *self.queue.popleft())
+
+    async def run(self, key, job, func, args, kwargs):
+        try:
+            await func(job, *args, **kwargs)
+            job.set_status('done')
+        except APIError as e:
+            job.fail(e.message)
+        except Exception as e:
+            app.logger.exception(f'Job {job.id} failed')
+            job.fail('Error parsing CSV: %s' % e)
+        finally:
+            self.active.pop(key, None)
+            self.running -= 1
+            self.start_jobs()
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'queued': len(self.queue),
+            'concurrency': self.concurrency,
+        }
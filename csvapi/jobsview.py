@@ -0,0 +1,19 @@
+from quart import jsonify, request, current_app as app
+from quart.views import MethodView
+
+from csvapi.errors import APIError
+
+
+class JobsView(MethodView):
+
+    async def get(self, job_id):
+        """Status of an ingestion job started with `/apify?async=yes`"""
+        job = app.jobs.get(job_id)
+        if job is None:
+            raise APIError('Job not found.', status=404)
+        scheme = 'https' if app.config.get('FORCE_SSL') else request.scheme
+        return jsonify({
+            'ok': True,
+            'job': job.to_dict(),
+            'endpoint': f"{scheme}://{request.host}/api/{job.urlhash}",
+        })
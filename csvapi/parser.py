@@ -1,51 +1,251 @@
+import codecs
+import csv
+import datetime
+import itertools
 import os
+import shutil
+import sqlite3
+import tempfile
+import zipfile
 
 import agate
 import cchardet as chardet
 
+from agate.exceptions import CastError
+
+from csvapi.compression import COMPRESSIONS, open_decompressed
+from csvapi.pipeline import open_followed, wait_for_download
 from csvapi.utils import get_db_info
-from csvapi.type_tester import agate_tester
+from csvapi.type_tester import agate_tester, Time, SirenSiret
 import logging
 
 logging.captureWarnings(True)
 logging.getLogger("py.warnings").setLevel(logging.ERROR)
+log = logging.getLogger(__name__)
 
 SNIFF_LIMIT = 4096
+# bytes read at most to detect the encoding of a file
+ENCODING_DETECTION_LIMIT = 1024 * 1024
+ENCODING_CHUNK_SIZE = 64 * 1024
 CSV_FILETYPES = ('text/plain', 'application/csv', 'text/csv')
+# bytes read at the beginning of a file to detect its type
+TYPE_SNIFF_SIZE = 8192
+OLE2_MAGIC = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'
+ZIP_MAGIC = b'PK\x03\x04'
+GZIP_MAGIC = b'\x1f\x8b'
+BZ2_MAGIC = b'BZh'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+COMPRESSION_MAGICS = (GZIP_MAGIC, BZ2_MAGIC, XZ_MAGIC)
+UTF16_BOMS = (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+# number of rows used to infer column types
+TYPE_INFERENCE_LIMIT = 1000
+# number of rows inserted per `executemany` in streaming mode
+STREAM_BATCH_SIZE = 5000
+# in bytes, compressed spreadsheets are decompressed to disk by blocks of this size
+DECOMPRESSION_CHUNK_SIZE = 1024 * 1024
 
+# SQL types used by agate-sql for sqlite, so that both parsers produce the same schema
+SQL_TYPES = (
+    (agate.Boolean, 'BOOLEAN'),
+    (agate.Number, 'FLOAT'),
+    (agate.DateTime, 'TIMESTAMP'),
+    (agate.Date, 'DATE'),
+    (agate.TimeDelta, 'DATETIME'),
+    (Time, 'VARCHAR'),
+    (SirenSiret, 'VARCHAR'),
+    (agate.Text, 'VARCHAR'),
+)
+# SQLAlchemy stores intervals as an offset from epoch on sqlite
+EPOCH = datetime.datetime(1970, 1, 1)
 
-def detect_type(filepath):
-    with os.popen(f'file {filepath} -b --mime-type') as proc:
-        return proc.read().lower()
 
+class SemicolonDialect(csv.excel):
+    delimiter = ';'
 
-def detect_encoding(filepath):
-    with open(filepath, 'rb') as f:
-        return chardet.detect(f.read()).get('encoding')
 
+def make_opener(follow=False, compression=None, max_size=None):
+    """
+    Function opening files like `open` (read modes only), following files still being downloaded
+    if `follow` is set (cf `csvapi.pipeline`) and decompressing them if they have a `compression`,
+    up to `max_size` decompressed bytes (cf `csvapi.compression`).
+    """
+    base_opener = open_followed if follow else open
+    if not compression:
+        return base_opener
 
-def from_csv(filepath, encoding='utf-8', sniff_limit=SNIFF_LIMIT):
-    """Try first w/ sniffing and then w/o sniffing if it fails,
-    and then again by forcing ';' delimiter w/o sniffing"""
-    kwargs = {
-        'sniff_limit': sniff_limit,
-        'encoding': encoding,
-        'column_types': agate_tester()
-    }
+    def opener(filepath, mode='r', encoding=None, newline=None):
+        return open_decompressed(
+            base_opener(filepath, 'rb'), compression, mode=mode, max_size=max_size, encoding=encoding, newline=newline
+        )
 
-    with open(filepath, 'rb') as fp:
-        if len(fp.readlines()) < 2:
-            raise ValueError
+    return opener
 
-    try:
-        return agate.Table.from_csv(filepath, **kwargs)
-    except ValueError:
+
+def detect_type(filepath, head=None):
+    """
+    Detect the mime type of `filepath` from its magic bytes, `head` being
+    the beginning of the file if it has already been read.
+    Only the types we may support are told apart, others are `application/octet-stream`.
+    """
+    if head is None:
+        with open(filepath, 'rb') as f:
+            head = f.read(TYPE_SNIFF_SIZE)
+    if head.startswith(OLE2_MAGIC):
+        return 'application/vnd.ms-excel'
+    if head.startswith(ZIP_MAGIC):
         try:
-            kwargs.pop('sniff_limit')
-            return agate.Table.from_csv(filepath, **kwargs)
-        except ValueError:
-            kwargs['delimiter'] = ';'
-            return agate.Table.from_csv(filepath, **kwargs)
+            with zipfile.ZipFile(filepath) as archive:
+                if any(name.startswith('xl/') for name in archive.namelist()):
+                    return 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        except zipfile.BadZipFile:
+            pass
+        return 'application/zip'
+    # compressed files, cf `csvapi.compression`
+    if head.startswith(GZIP_MAGIC):
+        return 'application/gzip'
+    if head.startswith(BZ2_MAGIC):
+        return 'application/x-bzip2'
+    if head.startswith(XZ_MAGIC):
+        return 'application/x-xz'
+    if head.startswith(UTF16_BOMS):
+        return 'text/plain'
+    if b'\x00' in head:
+        return 'application/octet-stream'
+    start = head.lstrip(b'\xef\xbb\xbf \t\r\n')[:15].lower()
+    if start.startswith(b'{') or start.startswith(b'[') and start[1:].lstrip()[:1] in (b'{', b'[', b'"', b']'):
+        return 'application/json'
+    if start.startswith((b'<!doctype html', b'<html')):
+        return 'text/html'
+    if start.startswith(b'<?xml'):
+        return 'text/xml'
+    return 'text/plain'
+
+
+def detect_encoding(filepath, limit=ENCODING_DETECTION_LIMIT, opener=open):
+    """
+    Detect the encoding of `filepath` from at most its first `limit` bytes (None for the whole file),
+    read by chunks. Returns the encoding and the detection confidence (0 to 1).
+
+    Valid UTF-8 (thus ASCII) is recognized without running the detector. Otherwise the detector
+    is fed with the remaining chunks and we stop as soon as it is confident enough.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    detector = None
+    read = 0
+    with opener(filepath, 'rb') as f:
+        if f.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+            f.seek(0)
+        utf8 = 'utf-8' if f.tell() == 0 else 'utf-8-sig'
+        while limit is None or read < limit:
+            chunk = f.read(ENCODING_CHUNK_SIZE if limit is None else min(ENCODING_CHUNK_SIZE, limit - read))
+            read += len(chunk)
+            if detector is None:
+                try:
+                    decoder.decode(chunk, final=not chunk)
+                    if not chunk:
+                        break
+                    continue
+                except UnicodeDecodeError:
+                    detector = chardet.UniversalDetector()
+            if not chunk:
+                break
+            detector.feed(chunk)
+            if detector.done:
+                break
+    if detector is None:
+        return utf8, 1.0
+    detector.close()
+    return detector.result['encoding'], detector.result['confidence']
+
+
+def fits(row, nb_columns):
+    """A row fits a header if it has no extra value, trailing delimiters are tolerated"""
+    return len(row) <= nb_columns or not any(row[nb_columns:])
+
+
+def sniff_dialect(sample, truncated=True):
+    """
+    Detect the CSV dialect (delimiter, quoting) of `sample`, a prefix of the file
+    (the whole file if not `truncated`).
+
+    Candidates are tried in the historical order (sniffed, default, then forced ';')
+    against the prefix only: the first one whose rows all fit the header (first row) wins.
+    Returns the dialect and a confidence between 0 and 1, the share of sample rows
+    having exactly as many values as the header.
+    """
+    lines = sample.splitlines(keepends=True)
+    if truncated:
+        # the last line may have been cut
+        lines = lines[:-1] or [sample]
+    # the sniffer only recognizes quoted values at the end of lines if lines end with \n
+    sniffed = agate.csv.Sniffer().sniff(''.join(lines).replace('\r\n', '\n'))
+    candidates = [sniffed, csv.excel, SemicolonDialect]
+    best, best_confidence = candidates[-1], 0
+    for dialect in filter(None, candidates):
+        rows = [row for row in csv.reader(lines, dialect=dialect) if row]
+        if not rows:
+            continue
+        nb_columns = len(rows[0])
+        data = rows[1:]
+        confidence = sum(len(row) == nb_columns for row in data) / len(data) if data else 0
+        if all(fits(row, nb_columns) for row in data):
+            return dialect, confidence
+        if confidence > best_confidence:
+            best, best_confidence = dialect, confidence
+    return best, best_confidence
+
+
+def read_csv(f, sniff_limit=SNIFF_LIMIT):
+    """
+    Detect the dialect on the first `sniff_limit` characters of the text file `f`,
+    then return its column names and an iterator over its rows, padded to the header length.
+    """
+    sample = f.read(sniff_limit or SNIFF_LIMIT)
+    dialect, confidence = sniff_dialect(sample, truncated=bool(f.read(1)))
+    log.debug('Detected CSV delimiter %r (confidence %.2f)', dialect.delimiter, confidence)
+    f.seek(0)
+    reader = csv.reader(f, dialect=dialect)
+    header = next(reader, None)
+    if header is None:
+        raise ValueError('Empty file')
+    column_names = agate.utils.deduplicate(header, column_names=True)
+    nb_columns = len(column_names)
+
+    def rows():
+        for row in reader:
+            if len(row) > nb_columns:
+                # the dialect has been chosen on a prefix, we won't parse the file again
+                if not fits(row, nb_columns):
+                    raise ValueError(
+                        f'Row {reader.line_num} has {len(row)} values, but table only has {nb_columns} columns.'
+                    )
+                row = row[:nb_columns]
+            elif len(row) < nb_columns:
+                row = row + [None] * (nb_columns - len(row))
+            yield row
+
+    return column_names, rows()
+
+
+def from_csv(filepath, encoding='utf-8', sniff_limit=SNIFF_LIMIT, type_inference_limit=TYPE_INFERENCE_LIMIT,
+             opener=open):
+    """
+    Detect the dialect on a prefix of the file, then parse the whole file once.
+    Types are inferred on the first `type_inference_limit` rows (None for all rows).
+    """
+    # newlines in quoted values are kept as they are, cf `csv.reader`
+    with opener(filepath, encoding=encoding, newline='') as f:
+        column_names, rows = read_csv(f, sniff_limit=sniff_limit)
+        rows = list(rows)
+    if not rows:
+        raise ValueError('No data rows')
+    try:
+        return agate.Table(rows, column_names, column_types=agate_tester(limit=type_inference_limit))
+    except CastError:
+        if not type_inference_limit:
+            raise
+        # a value after the sample does not fit the inferred type, infer types on all rows
+        return agate.Table(rows, column_names, column_types=agate_tester())
 
 
 def from_excel(filepath, xlsx=False):
@@ -61,18 +261,183 @@ def to_sql(table, urlhash, storage):
     table.to_sql(db_info['dsn'], db_info['db_name'], overwrite=True)
 
 
-def parse(filepath, urlhash, storage, encoding=None, sniff_limit=SNIFF_LIMIT):
-    is_csv = False
-    file_type = detect_type(filepath)
-    if 'application/vnd.ms-excel' in file_type:
-        table = from_excel(filepath)
-    elif 'application/vnd.openxml' in file_type:
-        table = from_excel(filepath, xlsx=True)
-    elif any([supported in file_type for supported in CSV_FILETYPES]):
-        encoding = detect_encoding(filepath) if not encoding else encoding
-        table = from_csv(filepath, encoding=encoding, sniff_limit=sniff_limit)
-        is_csv = True
+def get_sql_type(data_type):
+    for agate_type, sql_type in SQL_TYPES:
+        if isinstance(data_type, agate_type):
+            return sql_type
+    raise ValueError(f'Unsupported column type: {data_type}')
+
+
+def make_converter(data_type):
+    """Build a function casting a raw CSV value to what agate-sql would have stored"""
+    if isinstance(data_type, agate.Number):
+        def to_storage(value):
+            return float(value)
+    elif isinstance(data_type, agate.DateTime):
+        def to_storage(value):
+            return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+    elif isinstance(data_type, agate.Date):
+        def to_storage(value):
+            return value.isoformat()
+    elif isinstance(data_type, agate.TimeDelta):
+        def to_storage(value):
+            return (EPOCH + value).strftime('%Y-%m-%d %H:%M:%S.%f')
+    else:
+        def to_storage(value):
+            return value
+
+    def convert(value):
+        try:
+            value = data_type.cast(value)
+        except CastError:
+            # type was inferred on a sample, keep values that do not fit as they are
+            # (sqlite columns accept any type) rather than failing the whole file
+            return value
+        return None if value is None else to_storage(value)
+
+    return convert
+
+
+def stream_csv_to_sql(filepath, urlhash, storage, encoding='utf-8', sniff_limit=SNIFF_LIMIT,
+                      sample_size=TYPE_INFERENCE_LIMIT, batch_size=STREAM_BATCH_SIZE, opener=open):
+    """
+    Stream a CSV file into sqlite without building an agate.Table.
+
+    Types are inferred on the first `sample_size` rows, then rows are cast
+    and inserted by batches of `batch_size`: memory usage does not depend
+    on the file size, unless `sample_size` is None (types inferred on all rows,
+    which are held in memory meanwhile).
+    """
+    db_info = get_db_info(urlhash, storage=storage)
+    with opener(filepath, encoding=encoding, newline='') as f:
+        column_names, rows = read_csv(f, sniff_limit=sniff_limit)
+        nb_columns = len(column_names)
+        sample_rows = list(itertools.islice(rows, sample_size))
+        if not sample_rows:
+            raise ValueError('No data rows')
+        column_types = agate_tester().run(sample_rows, column_names)
+        converters = [make_converter(t) for t in column_types]
+
+        conn = sqlite3.connect(db_info['db_path'])
+        try:
+            # the db is rebuilt from scratch: no need for a rollback journal nor for fsyncs
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            table = db_info['table_name']
+            columns = ', '.join(f'[{name}] {get_sql_type(t)}' for name, t in zip(column_names, column_types))
+            conn.execute(f'DROP TABLE IF EXISTS [{table}]')
+            conn.execute(f'CREATE TABLE [{table}] ({columns})')
+            insert = f"INSERT INTO [{table}] VALUES ({', '.join('?' * nb_columns)})"
+            all_rows = itertools.chain(sample_rows, rows)
+            while True:
+                batch = [
+                    tuple(convert(value) for convert, value in zip(converters, row))
+                    for row in itertools.islice(all_rows, batch_size)
+                ]
+                if not batch:
+                    break
+                conn.executemany(insert, batch)
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def parse_csv(filepath, urlhash, storage, encoding, sniff_limit=SNIFF_LIMIT, streaming=False,
+              type_inference_limit=TYPE_INFERENCE_LIMIT, opener=open):
+    if streaming:
+        stream_csv_to_sql(
+            filepath, urlhash, storage, encoding=encoding, sniff_limit=sniff_limit, sample_size=type_inference_limit,
+            opener=opener,
+        )
     else:
+        table = from_csv(
+            filepath, encoding=encoding, sniff_limit=sniff_limit, type_inference_limit=type_inference_limit,
+            opener=opener,
+        )
+        to_sql(table, urlhash, storage)
+
+
+def is_excel(file_type):
+    return 'application/vnd.ms-excel' in file_type or 'application/vnd.openxml' in file_type
+
+
+def parse_excel(filepath, file_type, urlhash, storage):
+    to_sql(from_excel(filepath, xlsx='application/vnd.openxml' in file_type), urlhash, storage)
+    return {'filetype': 'excel'}
+
+
+def parse_compressed_excel(filepath, urlhash, storage, opener):
+    """
+    Parse a compressed spreadsheet: spreadsheets are read from their end (and by path),
+    they cannot be decompressed as they are read like CSV files, cf `make_opener`.
+    They are decompressed to a temporary file of `storage` first.
+    """
+    with tempfile.NamedTemporaryFile(dir=storage, delete=False) as tmp:
+        with opener(filepath, 'rb') as f:
+            shutil.copyfileobj(f, tmp, DECOMPRESSION_CHUNK_SIZE)
+    try:
+        file_type = detect_type(tmp.name)
+        if not is_excel(file_type):
+            raise Exception(f'Unsupported compressed file type {file_type}')
+        return parse_excel(tmp.name, file_type, urlhash, storage)
+    finally:
+        os.remove(tmp.name)
+
+
+def parse(filepath, urlhash, storage, encoding=None, sniff_limit=SNIFF_LIMIT, streaming=False,
+          encoding_limit=ENCODING_DETECTION_LIMIT, type_inference_limit=TYPE_INFERENCE_LIMIT, follow=False,
+          max_decompressed_size=None):
+    """
+    Parse `filepath` into `{storage}/{urlhash}.db`.
+    Returns infos about the file: its type and, for CSV files, its encoding and compression.
+
+    Compressed (gzip, bz2, xz or zip) CSV files are decompressed as they are read,
+    up to `max_decompressed_size` bytes: the decompressed file is never written to disk.
+
+    With `follow`, `filepath` is still being downloaded (cf `csvapi.pipeline`): CSV files are parsed
+    as data comes in, other files once they are complete.
+    """
+    opener = make_opener(follow=follow)
+    with opener(filepath, 'rb') as f:
+        head = f.read(TYPE_SNIFF_SIZE)
+    if follow and head.startswith((OLE2_MAGIC, ZIP_MAGIC)):
+        # spreadsheets (and zip archives in general) are read from their end
+        wait_for_download(filepath)
+    file_type = detect_type(filepath, head=head)
+    compression = COMPRESSIONS.get(file_type)
+    if compression:
+        opener = make_opener(follow=follow, compression=compression, max_size=max_decompressed_size)
+        with opener(filepath, 'rb') as f:
+            head = f.read(TYPE_SNIFF_SIZE)
+        if head.startswith(COMPRESSION_MAGICS):
+            raise Exception(f'Unsupported compressed file type {file_type}')
+        if head.startswith((OLE2_MAGIC, ZIP_MAGIC)):
+            # e.g. a spreadsheet served with `Content-Encoding: gzip`
+            return parse_compressed_excel(filepath, urlhash, storage, opener)
+        file_type = detect_type(filepath, head=head)
+    if is_excel(file_type):
+        return parse_excel(filepath, file_type, urlhash, storage)
+    elif not any([supported in file_type for supported in CSV_FILETYPES]):
         raise Exception(f'Unsupported file type {file_type}')
-    to_sql(table, urlhash, storage)
-    return is_csv
+
+    csv_options = {
+        'sniff_limit': sniff_limit,
+        'streaming': streaming,
+        'type_inference_limit': type_inference_limit,
+        'opener': opener,
+    }
+    if encoding:
+        parse_csv(filepath, urlhash, storage, encoding, **csv_options)
+        return {'filetype': 'csv', 'encoding': encoding, 'encoding_confidence': None, 'compression': compression}
+
+    encoding, confidence = detect_encoding(filepath, limit=encoding_limit, opener=opener)
+    try:
+        parse_csv(filepath, urlhash, storage, encoding, **csv_options)
+    except UnicodeDecodeError:
+        if encoding_limit is None:
+            raise
+        # the beginning of the file was misleading (e.g. only ASCII): detect again on the whole file
+        log.warning('Encoding %s detected on a sample does not fit %s, detecting again', encoding, urlhash)
+        encoding, confidence = detect_encoding(filepath, limit=None, opener=opener)
+        parse_csv(filepath, urlhash, storage, encoding, **csv_options)
+    return {'filetype': 'csv', 'encoding': encoding, 'encoding_confidence': confidence, 'compression': compression}
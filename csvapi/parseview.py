@@ -1,26 +1,19 @@
+import asyncio
 import os
 import tempfile
 
-import aiohttp
 import validators
-import pandas as pd
 
 from quart import request, jsonify, current_app as app
 from quart.views import MethodView
 
 from csvapi.errors import APIError
-from csvapi.parser import parse
-from csvapi.profiling import CSVAPIProfileReport
-from csvapi.utils import (
-    already_exists,
-    get_hash,
-    check_csv_detective_report_structure,
-    check_profile_report_structure,
-    create_connection,
-    enrich_db_with_metadata
-)
-
-from csv_detective.explore_csv import routine
+from csvapi.indexes import INDEX_MAX_COLUMNS, INDEX_MIN_ROWS
+from csvapi.ingestion import analyse_db, build_db, discard_build, new_build_dir, swap_db
+from csvapi.jobs import Job
+from csvapi.pipeline import clear_download_marks, mark_download_complete, mark_download_failed
+from csvapi.singleflight import file_lock
+from csvapi.utils import already_exists, get_db_info, get_db_infos, get_hash, run_in_executor
 
 
 class ParseView(MethodView):
@@ -32,77 +25,143 @@ class ParseView(MethodView):
         encoding,
         storage,
         logger,
+        downloader,
         sniff_limit,
         max_file_size,
-        analysis=None
+        analysis=None,
+        streaming=False,
+        encoding_limit=None,
+        type_inference_limit=None,
+        index_min_rows=INDEX_MIN_ROWS,
+        index_max_columns=INDEX_MAX_COLUMNS,
+        search_index=False,
+        job=None,
+        pipelined=False,
+        max_decompressed_size=None,
     ):
+        """
+        Download `url` and parse it into `{storage}/{urlhash}.db`.
+        If a `job` is given, its status and the downloaded bytes are updated along the way.
+        If `pipelined`, parsing starts as soon as the download does and reads the file as it comes in.
+        """
         logger.debug('* do_parse %s (%s)', urlhash, url)
         tmp = tempfile.NamedTemporaryFile(delete=False)
-        chunk_count = 0
-        chunk_size = 1024
-        try:
-            async with aiohttp.ClientSession(raise_for_status=True) as session:
-                async with session.get(url) as resp:
-                    while True:
-                        chunk = await resp.content.read(chunk_size)
-                        if chunk_count * chunk_size > max_file_size:
-                            tmp.close()
-                            raise Exception('File too big (max size is %s bytes)' % max_file_size)
-                        if not chunk:
-                            break
-                        tmp.write(chunk)
-                        chunk_count += 1
-            tmp.close()
-
-            logger.debug('* Downloaded %s', urlhash)
-            logger.debug('* Parsing %s...', urlhash)
-            is_csv = parse(
-                tmp.name,
-                urlhash,
-                storage,
-                encoding=encoding,
-                sniff_limit=sniff_limit
-            )
-
-            if is_csv and analysis and analysis == 'yes':
-                csv_detective_report = routine(tmp.name)
-
-                if not check_csv_detective_report_structure(csv_detective_report):
-                    logger.error(
-                        "csvdetective report malformed"
-                    )
-                    return
-
-                profile_report = await CSVAPIProfileReport().get_minimal_profile(urlhash)
-
-                if not check_profile_report_structure(profile_report):
-                    logger.error(
-                        "pandas profiling report malformed"
-                    )
-                    return
-
-                enrich_db_with_metadata(
-                    urlhash,
-                    csv_detective_report,
-                    profile_report,
-                    None,
-                    None
+        tmp.close()
+        build_dir = new_build_dir(urlhash, storage)
+        build_options = dict(
+            encoding=encoding,
+            sniff_limit=sniff_limit,
+            streaming=streaming,
+            encoding_limit=encoding_limit,
+            type_inference_limit=type_inference_limit,
+            index_min_rows=index_min_rows,
+            index_max_columns=index_max_columns,
+            search_index=search_index,
+            max_decompressed_size=max_decompressed_size,
+        )
+        parsing = None
+
+        def progress(nb_bytes, total_bytes):
+            nonlocal parsing
+            if job:
+                job.set_progress(nb_bytes, total_bytes)
+            if pipelined and parsing is None:
+                logger.debug('* Parsing %s while downloading...', urlhash)
+                parsing = asyncio.ensure_future(
+                    run_in_executor(build_db, tmp.name, urlhash, build_dir, follow=True, **build_options)
                 )
 
-            if not is_csv and analysis and analysis == 'yes':
-                conn = create_connection(f"{app.config['DB_ROOT_DIR']}/{urlhash}.db")
-                general_infos = [
-                    {
-                        'filetype': 'excel'
-                    }
-                ]
-                df = pd.DataFrame(general_infos)
-                df.to_sql('general_infos', con=conn, if_exists='replace', index=False)
-
+        try:
+            if job:
+                job.set_status('downloading')
+            # the file is not downloaded again if it has not changed since the db was built,
+            # unless the db has to be analysed or it has been decoded with another encoding
+            source = {}
+            if analysis != 'yes':
+                source = await asyncio.get_running_loop().run_in_executor(
+                    None, get_db_infos, get_db_info(urlhash, storage=storage)['db_path']
+                )
+                if source.get('source_encoding') != encoding:
+                    source = {}
+            try:
+                download = await downloader.download(
+                    url,
+                    tmp.name,
+                    max_file_size,
+                    etag=source.get('source_etag'),
+                    last_modified=source.get('source_last_modified'),
+                    progress=progress,
+                )
+            except BaseException:
+                if parsing:
+                    # stop the parser, waiting for more data
+                    mark_download_failed(tmp.name)
+                    await asyncio.gather(parsing, return_exceptions=True)
+                raise
+            if download['not_modified']:
+                logger.info('* %s has not changed, keeping %s.db', url, urlhash)
+                return
+            logger.debug('* Downloaded %s', urlhash)
+            if job:
+                job.set_status('parsing')
+            if parsing:
+                mark_download_complete(tmp.name)
+                infos = await parsing
+            else:
+                logger.debug('* Parsing %s...', urlhash)
+                # each step is a separate executor job, so that the job status follows them (cf `ingest`)
+                infos = await run_in_executor(build_db, tmp.name, urlhash, build_dir, **build_options)
+            if analysis == 'yes':
+                if job:
+                    job.set_status('profiling')
+                await run_in_executor(analyse_db, tmp.name, urlhash, build_dir, infos)
+            db_infos = {
+                'source_etag': download['etag'],
+                'source_last_modified': download['last_modified'],
+                # encoding asked for, None if detected
+                'source_encoding': encoding,
+            }
+            await run_in_executor(swap_db, urlhash, build_dir, storage, db_infos=db_infos)
             logger.debug('* Parsed %s', urlhash)
         finally:
             logger.debug('Removing tmp file: %s', tmp.name)
             os.unlink(tmp.name)
+            clear_download_marks(tmp.name)
+            discard_build(build_dir)
+
+    async def ingest_once(self, url, urlhash, encoding, analysis, job=None):
+        """
+        Download and parse `url`, holding a lock file shared by all workers:
+        a worker waiting for the lock does not parse the file again if the other one succeeded.
+        """
+        storage = app.config['DB_ROOT_DIR']
+        async with file_lock(f'{storage}/{urlhash}.lock'):
+            if await already_exists(urlhash, analysis):
+                app.logger.info(f"{urlhash}.db has just been parsed by another worker, skipping parse.")
+                return
+            await self.do_parse(url=url,
+                                urlhash=urlhash,
+                                encoding=encoding,
+                                storage=storage,
+                                logger=app.logger,
+                                downloader=app.downloader,
+                                sniff_limit=app.config.get('CSV_SNIFF_LIMIT'),
+                                max_file_size=app.config.get('MAX_FILE_SIZE'),
+                                analysis=analysis,
+                                streaming=app.config.get('CSV_STREAMING_PARSE'),
+                                encoding_limit=app.config.get('ENCODING_DETECTION_LIMIT'),
+                                type_inference_limit=app.config.get('TYPE_INFERENCE_LIMIT'),
+                                index_min_rows=app.config.get('INDEX_MIN_ROWS', INDEX_MIN_ROWS),
+                                index_max_columns=app.config.get('INDEX_MAX_COLUMNS', INDEX_MAX_COLUMNS),
+                                search_index=app.config.get('SEARCH_INDEX', True),
+                                job=job,
+                                pipelined=app.config.get('PIPELINED_PARSE', False),
+                                max_decompressed_size=app.config.get('MAX_DECOMPRESSED_SIZE'))
+
+    async def run_job(self, job, encoding, analysis):
+        await app.ingestions.run(
+            (job.urlhash, analysis == 'yes', encoding), self.ingest_once, job.url, job.urlhash, encoding, analysis, job
+        )
 
     async def get(self):
         app.logger.debug('* Starting ParseView.get')
@@ -114,22 +173,32 @@ class ParseView(MethodView):
             raise APIError('Malformed url parameter.', status=400)
         urlhash = get_hash(url)
         analysis = request.args.get('analysis')
+        scheme = 'https' if app.config.get('FORCE_SSL') else request.scheme
+        if request.args.get('async') == 'yes':
+            if await already_exists(urlhash, analysis):
+                job = app.jobs.add(Job(url, urlhash, status='done'))
+            else:
+                job = app.jobs.submit(
+                    (urlhash, analysis == 'yes', encoding), Job(url, urlhash), self.run_job, encoding, analysis
+                )
+            return jsonify({
+                'ok': True,
+                'job': job.to_dict(),
+                'job_endpoint': f"{scheme}://{request.host}/jobs/{job.id}",
+                'endpoint': f"{scheme}://{request.host}/api/{urlhash}",
+            }), 202
         if not await already_exists(urlhash, analysis):
             try:
-                storage = app.config['DB_ROOT_DIR']
-                await self.do_parse(url=url,
-                                    urlhash=urlhash,
-                                    encoding=encoding,
-                                    storage=storage,
-                                    logger=app.logger,
-                                    sniff_limit=app.config.get('CSV_SNIFF_LIMIT'),
-                                    max_file_size=app.config.get('MAX_FILE_SIZE'),
-                                    analysis=analysis)
+                # concurrent requests for the same file share a single download and parse
+                await app.ingestions.run(
+                    (urlhash, analysis == 'yes', encoding), self.ingest_once, url, urlhash, encoding, analysis
+                )
+            except APIError:
+                raise
             except Exception as e:
                 raise APIError('Error parsing CSV: %s' % e)
         else:
             app.logger.info(f"{urlhash}.db already exists, skipping parse.")
-        scheme = 'https' if app.config.get('FORCE_SSL') else request.scheme
         return jsonify({
             'ok': True,
             'endpoint': f"{scheme}://{request.host}/api/{urlhash}",
@@ -0,0 +1,97 @@
+import io
+import os
+import time
+
+# in seconds, how often a file being downloaded is checked for new data...
+FOLLOW_POLL_INTERVAL = 0.05
+# ...and how long to wait for new data before giving up
+FOLLOW_TIMEOUT = 300
+
+COMPLETE_SUFFIX = '.complete'
+FAILED_SUFFIX = '.failed'
+
+
+class DownloadFailed(Exception):
+    pass
+
+
+def mark_download_complete(path):
+    open(f'{path}{COMPLETE_SUFFIX}', 'w').close()
+
+
+def mark_download_failed(path):
+    open(f'{path}{FAILED_SUFFIX}', 'w').close()
+
+
+def clear_download_marks(path):
+    for suffix in (COMPLETE_SUFFIX, FAILED_SUFFIX):
+        if os.path.exists(f'{path}{suffix}'):
+            os.remove(f'{path}{suffix}')
+
+
+def is_download_complete(path):
+    if os.path.exists(f'{path}{FAILED_SUFFIX}'):
+        raise DownloadFailed(f'Download of {path} failed')
+    return os.path.exists(f'{path}{COMPLETE_SUFFIX}')
+
+
+def wait_for_download(path, timeout=FOLLOW_TIMEOUT, poll_interval=FOLLOW_POLL_INTERVAL):
+    waited = 0
+    while not is_download_complete(path):
+        if waited >= timeout:
+            raise TimeoutError(f'Download of {path} is not complete after {timeout}s')
+        time.sleep(poll_interval)
+        waited += poll_interval
+
+
+class FollowedFile(io.RawIOBase):
+    """
+    Read a file while it is being downloaded (possibly by another process): at the end of the data
+    written so far, reads wait for more data until the download is marked as complete (or failed),
+    cf `mark_download_complete`.
+    """
+
+    def __init__(self, path, timeout=FOLLOW_TIMEOUT, poll_interval=FOLLOW_POLL_INTERVAL):
+        self.path = path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.raw = open(path, 'rb', buffering=0)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        waited = 0
+        while True:
+            # checked before reading: once complete, an empty read is the actual end of the file
+            complete = is_download_complete(self.path)
+            nb_bytes = self.raw.readinto(b)
+            if nb_bytes or complete:
+                return nb_bytes
+            if waited >= self.timeout:
+                raise TimeoutError(f'No data downloaded to {self.path} for {self.timeout}s')
+            time.sleep(self.poll_interval)
+            waited += self.poll_interval
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_END:
+            wait_for_download(self.path, timeout=self.timeout, poll_interval=self.poll_interval)
+        return self.raw.seek(offset, whence)
+
+    def tell(self):
+        return self.raw.tell()
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+def open_followed(path, mode='r', encoding=None, newline=None):
+    '''Like `open` (read modes only) for a file being downloaded, cf `FollowedFile`'''
+    f = io.BufferedReader(FollowedFile(path))
+    if 'b' in mode:
+        return f
+    return io.TextIOWrapper(f, encoding=encoding, newline=newline)
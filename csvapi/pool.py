@@ -0,0 +1,77 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+from csvapi.utils import get_db_signature
+
+
+def prepare_connection(conn):
+    # conn.row_factory = sqlite3.Row
+    conn.text_factory = lambda x: str(x, 'utf-8', 'replace')
+
+
+class ConnectionPool:
+    """
+    Long-lived read-only connections to the sqlite databases, reused across requests.
+
+    At most `size` idle connections are kept by database, and at most `max_databases`
+    databases keep connections open: the least recently used ones are closed.
+    When a database file changes on disk (e.g. it has been parsed again),
+    its connections are dropped and new ones are opened.
+    """
+
+    def __init__(self, size=4, max_databases=32):
+        self.size = size
+        self.max_databases = max_databases
+        # db_path -> {'signature': ..., 'idle': [connections]}, least recently used first
+        self.databases = OrderedDict()
+
+    async def connect(self, db_path):
+        # dbs are only written at parse time, `immutable=1` skips locking and change detection.
+        # specify uri=True to make sure `file:xxx` is supported,
+        # however the backend sqlite is configured (eg default MacOS)
+        conn = aiosqlite.connect(f'file:{db_path}?immutable=1', uri=True)
+        # pooled connections outlive requests, they must not prevent the process from exiting
+        conn.daemon = True
+        await conn
+        prepare_connection(conn)
+        return conn
+
+    async def acquire(self, db_path):
+        signature = get_db_signature(db_path)
+        database = self.databases.get(db_path)
+        if database is not None and database['signature'] != signature:
+            await self.close_database(db_path)
+            database = None
+        if database is None:
+            database = self.databases[db_path] = {'signature': signature, 'idle': []}
+            while len(self.databases) > self.max_databases:
+                await self.close_database(next(iter(self.databases)))
+        self.databases.move_to_end(db_path)
+        conn = database['idle'].pop() if database['idle'] else await self.connect(db_path)
+        return conn, database
+
+    async def release(self, db_path, conn, database):
+        # the database may have been evicted or replaced while the connection was in use
+        if self.databases.get(db_path) is database and len(database['idle']) < self.size:
+            database['idle'].append(conn)
+        else:
+            await conn.close()
+
+    @asynccontextmanager
+    async def connection(self, db_path):
+        conn, database = await self.acquire(db_path)
+        try:
+            yield conn
+        finally:
+            await self.release(db_path, conn, database)
+
+    async def close_database(self, db_path):
+        database = self.databases.pop(db_path, None)
+        for conn in database['idle'] if database else []:
+            await conn.close()
+
+    async def close(self):
+        for db_path in list(self.databases):
+            await self.close_database(db_path)
@@ -17,11 +17,14 @@ class CSVAPIProfileReport:
         dsn = 'file:{}?immutable=1'.format(db_info['db_path'])
         conn = sqlite3.connect(dsn, uri=True)
         sql = 'SELECT * FROM [{}]'.format(db_info['table_name'])
-        df = pd.read_sql_query(sql, con=conn)
-        return df
+        try:
+            return pd.read_sql_query(sql, con=conn)
+        finally:
+            # profiling runs in long-lived executor processes, do not leak connections
+            conn.close()
 
-    async def get_minimal_profile(self, urlhash: str) -> dict:
-        db_info = get_db_info(urlhash)
+    def get_minimal_profile(self, urlhash: str, storage: str = None) -> dict:
+        db_info = get_db_info(urlhash, storage=storage)
         p = Path(db_info['db_path'])
         if not p.exists():
             raise APIError('Database has probably been removed or does not exist yet.', status=404)
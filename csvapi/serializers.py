@@ -0,0 +1,39 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def json_dumps(obj):
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps(obj):
+    return orjson.dumps(obj)
+
+
+SERIALIZERS = {
+    'json': json_dumps,
+    'orjson': orjson_dumps,
+}
+
+
+def get_serializer(name='auto'):
+    '''
+    Function serializing API responses to JSON bytes: `orjson` (much faster, if installed) or `json`.
+    `auto` picks the fastest one available. Rows can be passed as tuples, as returned by sqlite.
+    '''
+    if name in (None, 'auto'):
+        name = 'orjson' if orjson else 'json'
+    if name not in SERIALIZERS:
+        raise ValueError(f'Unknown JSON serializer {name}')
+    if name == 'orjson' and not orjson:
+        raise ValueError('orjson serializer requires orjson to be installed')
+    return SERIALIZERS[name]
+
+
+def rows_to_objects(columns, rows):
+    # faster than building rows from a JSON template in CPython, with both serializers
+    return [dict(zip(columns, row)) for row in rows]
@@ -0,0 +1,101 @@
+import asyncio
+import os
+
+from contextlib import asynccontextmanager, contextmanager
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, only in-process deduplication then
+    fcntl = None
+
+# in seconds, how often a lock file held by someone else is checked, cf `file_lock`
+LOCK_POLL_INTERVAL = 0.05
+
+
+class SingleFlight:
+    """
+    Run at most one call by key at a time: callers with the same key while it runs wait for its result
+    (or its exception) instead of doing the same work again.
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    async def run(self, key, func, *args, **kwargs):
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self.calls[key] = task
+
+            def forget(done):
+                if self.calls.get(key) is done:
+                    del self.calls[key]
+            task.add_done_callback(forget)
+        # a caller going away (e.g. client disconnection) must not cancel the call for the others
+        return await asyncio.shield(task)
+
+
+def acquire_file_lock(path, blocking=True):
+    '''
+    Lock `path` exclusively, creating it if needed. Returns the file descriptor holding the lock,
+    or None if not `blocking` and the lock is held by someone else.
+    '''
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        # the previous holder removes the file when releasing the lock, make sure we locked the current one
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+def release_file_lock(path, fd):
+    os.unlink(path)
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+@asynccontextmanager
+async def file_lock(path, poll_interval=LOCK_POLL_INTERVAL):
+    '''
+    Exclusive lock shared between processes (e.g. hypercorn workers).
+    A lock held by someone else is polled: waiting for it does not hold a thread of the default executor,
+    used by exports and downloads.
+    '''
+    if fcntl is None:
+        yield
+        return
+    fd = acquire_file_lock(path, blocking=False)
+    while fd is None:
+        await asyncio.sleep(poll_interval)
+        fd = acquire_file_lock(path, blocking=False)
+    try:
+        yield
+    finally:
+        release_file_lock(path, fd)
+
+
+@contextmanager
+def try_file_lock(path):
+    '''`file_lock` for synchronous code, without waiting: yields whether the lock has been acquired'''
+    if fcntl is None:
+        yield True
+        return
+    fd = acquire_file_lock(path, blocking=False)
+    if fd is None:
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        release_file_lock(path, fd)
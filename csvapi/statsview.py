@@ -0,0 +1,18 @@
+from quart import jsonify, current_app as app
+from quart.views import MethodView
+
+
+class StatsView(MethodView):
+
+    async def get(self):
+        """Hits and misses of the in-memory caches, ingestion jobs and downloads"""
+        return jsonify({
+            'ok': True,
+            'caches': {
+                'responses': app.response_cache.stats(),
+                'metadata': app.metadata_cache.stats(),
+                'counts': app.count_cache.stats(),
+            },
+            'jobs': app.jobs.stats(),
+            'downloads': app.downloader.stats(),
+        })
@@ -1,25 +1,47 @@
-import aiosqlite
+import base64
+import json
 import sqlite3
 import time
 
 from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from urllib.parse import urlencode
 from pathlib import Path
 
-from quart import request, jsonify, current_app as app
+from quart import Response, request, current_app as app
 from quart.views import MethodView
 from slugify import slugify
 
 from csvapi.errors import APIError
-from csvapi.utils import get_db_info
+from csvapi.indexes import (
+    INDEX_MIN_ROWS,
+    INDEXABLE_COMPARATORS,
+    INDEXED_COLUMNS_SQL,
+    SEARCH_MIN_LENGTH,
+    add_indexes,
+    search_phrase,
+    search_table,
+    sqlite_lower,
+)
+from csvapi.serializers import rows_to_objects
+from csvapi.utils import get_db_info, get_db_signature, get_hash, run_in_executor
 
 ROWS_LIMIT = 100
 SQL_TIME_LIMIT_MS = 1000
 DEFAULT_SHAPE = 'lists'
-
-
-def prepare_connection(conn):
-    # conn.row_factory = sqlite3.Row
-    conn.text_factory = lambda x: str(x, 'utf-8', 'replace')
+METADATA_TABLES = (
+    'general_infos',
+    'columns_infos',
+    'top_infos',
+    'categorical_infos',
+    'numeric_infos',
+    'numeric_plot_infos',
+    'csvapi_infos',
+)
+# in seconds, how long clients and proxies can use a response without checking it has not changed
+HTTP_CACHE_MAX_AGE = 60
+# number of rows used to estimate filtered totals with `_total=estimate`
+TOTAL_ESTIMATE_SAMPLE = 100000
 
 
 @asynccontextmanager
@@ -38,19 +60,18 @@ async def sqlite_timelimit(conn, ms):
             return 1
 
     await conn.set_progress_handler(handler, n)
-    yield
-    await conn.set_progress_handler(None, n)
+    try:
+        yield
+    finally:
+        # connections are pooled, do not leave an expired handler behind
+        await conn.set_progress_handler(None, n)
 
 
 class TableView(MethodView):
 
     async def execute(self, sql, db_info, params=None):
-        """Executes sql against db_name in a thread"""
-        dsn = 'file:{}?immutable=1'.format(db_info['db_path'])
-        # specify uri=True to make sure `file:xxx` is supported,
-        # however the backend sqlite is configured (eg default MacOS)
-        async with aiosqlite.connect(dsn, uri=True) as conn:
-            conn.text_factory = lambda x: str(x, 'utf-8', 'replace')
+        """Executes sql against db_name in a thread, with a pooled connection"""
+        async with app.db_pool.connection(db_info['db_path']) as conn:
             # this will raise
             #  {"details": "interrupted",
             #  "error": "Error selecting data",}
@@ -65,16 +86,38 @@ class TableView(MethodView):
                     raise
             return rows, cursor.description
 
-    def add_filters_to_sql(self, sql, filters):
+    def add_filters_to_sql(self, sql, filters, metadata=None):
+        """
+        Add a WHERE clause for `filters`, a list of (`column__comparator`, value) or ('_search', value).
+
+        `__contains` filters and `_search` use the full text index of the db when there is one
+        (cf `metadata`), otherwise they are `LIKE` conditions.
+        """
+        search_columns = metadata['search_columns'] if metadata else set()
+        table = metadata['table_name'] if metadata else None
         wheres = []
         params = {}
         for (f_key, f_value) in filters:
+            if f_key == '_search':
+                if search_columns and len(f_value) >= SEARCH_MIN_LENGTH:
+                    wheres.append(f"rowid IN (SELECT rowid FROM [{search_table(table)}] "
+                                  f"WHERE [{search_table(table)}] MATCH :search_value)")
+                    params['search_value'] = search_phrase(f_value)
+                else:
+                    columns = [c for c, t in metadata['columns'] if t.upper() == 'VARCHAR'] if metadata else []
+                    wheres.append('({})'.format(' OR '.join(f"[{c}] LIKE :search_value" for c in columns) or '0'))
+                    params['search_value'] = f'%{f_value}%'
+                continue
             comparator = f_key.split('__')[1]
             column = f_key.split('__')[0]
             normalized_column = slugify(column, separator='_')
             if comparator == 'exact':
                 wheres.append(f"[{column}] = :filter_value_{normalized_column}")
                 params[f'filter_value_{normalized_column}'] = f_value
+            elif comparator == 'contains' and column.lower() in search_columns and len(f_value) >= SEARCH_MIN_LENGTH:
+                wheres.append(f"rowid IN (SELECT rowid FROM [{search_table(table)}] "
+                              f"WHERE [{column}] MATCH :filter_value_{normalized_column})")
+                params[f'filter_value_{normalized_column}'] = search_phrase(f_value)
             elif comparator == 'contains':
                 wheres.append(f"[{column}] LIKE :filter_value_{normalized_column}")
                 params[f'filter_value_{normalized_column}'] = f'%{f_value}%'
@@ -99,62 +142,211 @@ class TableView(MethodView):
             sql += ' AND '.join(wheres)
         return sql, params
 
-    async def data(self, db_info, export=False):
-        limit = request.args.get('_size', ROWS_LIMIT) if not export else -1
-        rowid = not (request.args.get('_rowid') == 'hide') and not export
-        total = not (request.args.get('_total') == 'hide') and not export
-        sort = request.args.get('_sort')
-        sort_desc = request.args.get('_sort_desc')
-        offset = request.args.get('_offset') if not export else 0
-
-        # get filter arguments, like column__exact=xxx
+    def get_filters(self):
+        """Filter arguments, like column__exact=xxx, and full text search"""
         filters = []
         for key, value in request.args.items():
             if not key.startswith('_') and '__' in key:
                 filters.append((key, value))
+        if request.args.get('_search'):
+            filters.append(('_search', request.args['_search']))
+        return filters
+
+    async def query(self, db_info, filters, export=False):
+        """
+        SQL query (and its params) selecting the rows asked for in the query string: filters, sort and page.
+        Exports select every matching row, without rowid.
+        """
+        limit = request.args.get('_size', ROWS_LIMIT) if not export else -1
+        sort = request.args.get('_sort')
+        sort_desc = request.args.get('_sort_desc')
+        offset = request.args.get('_offset') if not export else 0
+        next_token = request.args.get('_next') if not export else None
+        metadata = await self.metadata(db_info) if filters else None
 
-        cols = 'rowid, *' if rowid else '*'
+        # the rowid of the last row is needed to build the `next` token
+        cols = 'rowid, *' if not export else '*'
         sql = 'SELECT {} FROM [{}]'.format(cols, db_info['table_name'])
-        sql, params = self.add_filters_to_sql(sql, filters)
+        sql, params = self.add_filters_to_sql(sql, filters, metadata)
+        if next_token:
+            seek, seek_params = self.seek_clause(sort or sort_desc, bool(sort_desc), *self.decode_next(next_token))
+            sql += ' AND ' if params else ' WHERE '
+            sql += seek
+            params.update(seek_params)
+        # rowid breaks ties, so that the order is stable across pages
         if sort:
-            sql += f' ORDER BY [{sort}]'
+            sql += f' ORDER BY [{sort}], rowid'
         elif sort_desc:
-            sql += f' ORDER BY [{sort_desc}] DESC'
+            sql += f' ORDER BY [{sort_desc}] DESC, rowid'
         else:
             sql += ' ORDER BY rowid'
         sql += ' LIMIT :l'
         params['l'] = limit
-        if offset:
+        if offset and not next_token:
             sql += ' OFFSET :o'
             params['o'] = offset
+        return sql, params
+
+    async def data(self, db_info):
+        limit = request.args.get('_size', ROWS_LIMIT)
+        rowid = not (request.args.get('_rowid') == 'hide')
+        total = not (request.args.get('_total') == 'hide')
+        sort = request.args.get('_sort')
+        sort_desc = request.args.get('_sort_desc')
+
+        filters = self.get_filters()
+        sql, params = await self.query(db_info, filters)
         rows, description = await self.execute(
             sql, db_info, params=params
         )
 
         columns = [r[0] for r in description]
 
-        if export:
-            return columns, rows
+        if filters or sort or sort_desc:
+            await self.track_columns(db_info, filters, sort or sort_desc)
 
         res = {
-            'columns': columns,
-            'rows': list(rows),
+            'columns': columns if rowid else columns[1:],
+            'rows': list(rows) if rowid else [row[1:] for row in rows],
         }
 
+        if rows and len(rows) == self.page_size(limit):
+            sort_column = sort or sort_desc
+            # sqlite column names are case insensitive
+            sort_index = next((i for i, c in enumerate(columns) if c.lower() == sort_column.lower()), None) \
+                if sort_column else None
+            if not sort_column or sort_index is not None:
+                sort_value = rows[-1][sort_index] if sort_column else None
+                res['next'] = self.encode_next(sort_value, rows[-1][0])
+
         if total:
-            sql = f"SELECT COUNT(*) FROM [{db_info['table_name']}]"
-            sql, params = self.add_filters_to_sql(sql, filters)
-            r, _ = await self.execute(sql, db_info, params=params)
-            res['total'] = r[0][0]
+            estimate = request.args.get('_total') == 'estimate'
+            res['total'], estimated = await self.total(db_info, filters, estimate=estimate)
+            if estimated:
+                res['total_estimated'] = True
 
         return res
 
+    async def track_columns(self, db_info, filters, sort_column):
+        """Index columns that are often filtered or sorted on, once the advisor says so"""
+        metadata = await self.metadata(db_info)
+        if metadata['db_infos'].get('row_count', 0) < app.config.get('INDEX_MIN_ROWS', INDEX_MIN_ROWS):
+            return
+        keys = [
+            key.split('__')[0] for key, _ in filters
+            if '__' in key and key.split('__')[1] in INDEXABLE_COMPARATORS
+        ]
+        if sort_column:
+            keys.append(sort_column)
+        # actual names of the columns: sqlite only folds the case of ASCII letters in column names
+        table_columns = {sqlite_lower(name): name for name, _ in metadata['columns']}
+        columns = {table_columns[sqlite_lower(key)] for key in keys if sqlite_lower(key) in table_columns}
+        columns = {column for column in columns if column.lower() not in metadata['indexed_columns']}
+        to_index = app.index_advisor.record(db_info['db_path'], metadata['signature'], sorted(columns))
+        if to_index:
+            app.add_background_task(self.index_columns, db_info, metadata['signature'], to_index)
+
+    async def index_columns(self, db_info, signature, columns):
+        try:
+            if await run_in_executor(add_indexes, db_info['db_path'], db_info['table_name'], columns, signature):
+                app.logger.info(f"Indexed columns {columns} of {db_info['db_name']}")
+        except Exception as e:
+            app.logger.warning(f"Could not index columns {columns} of {db_info['db_name']}: {e}")
+        finally:
+            app.index_advisor.done(db_info['db_path'], signature, columns)
+
+    def page_size(self, limit):
+        try:
+            return int(limit)
+        except ValueError:
+            return None
+
+    def encode_next(self, sort_value, rowid):
+        """Opaque pagination token: the sort value and rowid of the last row of the page"""
+        return base64.urlsafe_b64encode(json.dumps([sort_value, rowid]).encode('utf-8')).decode('ascii')
+
+    def decode_next(self, token):
+        try:
+            sort_value, rowid = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+            return sort_value, int(rowid)
+        except (ValueError, TypeError):
+            raise APIError('Invalid _next token.', status=400)
+
+    def seek_clause(self, column, desc, sort_value, rowid):
+        """
+        Condition selecting the rows after (sort_value, rowid) in the sort order,
+        so that the next page is read from there instead of skipping rows with OFFSET.
+        sqlite sorts NULL values first in ascending order, last in descending order.
+        """
+        params = {'seek_rowid': rowid}
+        if not column:
+            return 'rowid > :seek_rowid', params
+        if sort_value is None:
+            if desc:
+                return f'([{column}] IS NULL AND rowid > :seek_rowid)', params
+            return f'([{column}] IS NOT NULL OR rowid > :seek_rowid)', params
+        params['seek_value'] = sort_value
+        comparator = '<' if desc else '>'
+        clause = f'[{column}] {comparator} :seek_value OR ([{column}] = :seek_value AND rowid > :seek_rowid)'
+        if desc:
+            clause += f' OR [{column}] IS NULL'
+        return f'({clause})', params
+
+    async def total(self, db_info, filters, estimate=False):
+        """
+        Number of rows matching `filters`, as (total, estimated).
+
+        The number of rows of the table is stored at ingestion time and filtered counts are memoized.
+        With `estimate`, an uncached filtered count is extrapolated from the first
+        TOTAL_ESTIMATE_SAMPLE rows of the table instead of scanning it.
+        """
+        metadata = await self.metadata(db_info)
+        row_count = metadata['db_infos'].get('row_count')
+        if not filters and row_count is not None:
+            return row_count, False
+
+        key = (db_info['db_path'], metadata['signature'], tuple(sorted(filters)))
+        count = app.count_cache.get(key)
+        if count is not None:
+            return count, False
+
+        sample_size = app.config.get('TOTAL_ESTIMATE_SAMPLE', TOTAL_ESTIMATE_SAMPLE)
+        sql = f"SELECT COUNT(*) FROM [{db_info['table_name']}]"
+        sql, params = self.add_filters_to_sql(sql, filters, metadata)
+        if estimate and filters and row_count is not None and row_count > sample_size:
+            # rowids are contiguous in our tables, this only reads the first `sample_size` rows
+            sql += ' AND' if params else ' WHERE'
+            sql += ' rowid <= :estimate_sample'
+            params['estimate_sample'] = sample_size
+            r, _ = await self.execute(sql, db_info, params=params)
+            return round(r[0][0] * row_count / sample_size), True
+
+        r, _ = await self.execute(sql, db_info, params=params)
+        app.count_cache.set(key, r[0][0])
+        return r[0][0], False
+
     async def get(self, urlhash):
         db_info = get_db_info(urlhash)
         p = Path(db_info['db_path'])
         if not p.exists():
             raise APIError('Database has probably been removed.', status=404)
 
+        validators = self.http_validators(db_info)
+        if self.is_not_modified(*validators):
+            return self.not_modified(*validators)
+
+        # the ETag identifies both the db version and the query string
+        cache_key = (db_info['db_path'], self.normalized_args())
+        body = app.response_cache.get(cache_key, version=validators[0])
+        if body is None:
+            body = await self.response_body(db_info)
+            app.response_cache.set(cache_key, body, size=len(body), version=validators[0])
+
+        response = Response(body, mimetype='application/json')
+        self.set_http_cache_headers(response, *validators)
+        return response
+
+    async def response_body(self, db_info):
         start = time.time()
         try:
             data = await self.data(db_info)
@@ -165,160 +357,139 @@ class TableView(MethodView):
         _shape = request.args.get('_shape', DEFAULT_SHAPE)
         if _shape == 'objects':
             # Format data as an array of objects for the client
-            rows = []
-            for row in data['rows']:
-                rows.append(dict(zip(data['columns'], row)))
+            rows = rows_to_objects(data['columns'], data['rows'])
         elif _shape == 'lists':
             rows = data['rows']
         else:
             raise APIError(f"Unknown _shape: {_shape}", status=400)
 
-        general_infos = await self.general_infos(db_info)
-        columns_infos = await self.columns_infos(db_info)
+        metadata = await self.metadata(db_info)
 
         res = {
             'ok': True,
             'query_ms': (end - start) * 1000,
             'rows': rows,
             'columns': data['columns'],
-            'general_infos': general_infos,
-            'columns_infos': columns_infos
+            'general_infos': metadata['general_infos'],
+            'columns_infos': metadata['columns_infos']
         }
         if data.get('total'):
             res['total'] = data['total']
+        if data.get('total_estimated'):
+            res['total_estimated'] = True
+        if data.get('next'):
+            res['next'] = data['next']
+
+        # rows are serialized straight from sqlite tuples, without jsonify's overhead
+        return app.json_dumps(res)
+
+    def normalized_args(self):
+        return urlencode(sorted(request.args.items(multi=True)))
+
+    def http_validators(self, db_info):
+        """
+        ETag and Last-Modified of the response, computed without querying the db:
+        the response only depends on the db file (which changes when parsed again) and on the query string.
+        """
+        inode, mtime_ns, size = get_db_signature(db_info['db_path'])
+        etag = get_hash(f'{inode}-{mtime_ns}-{size}:{request.path}?{self.normalized_args()}')
+        last_modified = datetime.fromtimestamp(mtime_ns // 1_000_000_000, tz=timezone.utc)
+        return etag, last_modified
+
+    def is_not_modified(self, etag, last_modified):
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        if request.if_modified_since:
+            return last_modified <= request.if_modified_since
+        return False
+
+    def set_http_cache_headers(self, response, etag, last_modified):
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = app.config.get('HTTP_CACHE_MAX_AGE', HTTP_CACHE_MAX_AGE)
+
+    def not_modified(self, etag, last_modified):
+        response = Response('', status=304)
+        self.set_http_cache_headers(response, etag, last_modified)
+        return response
+
+    async def metadata(self, db_info):
+        """
+        General and columns infos of the db, and csvapi's own infos (`db_infos`),
+        cached until the db file changes.
+
+        The metadata tables are written once at parse time and dbs are read `immutable=1`,
+        so they are only read again when the db signature changes (i.e. it has been parsed again).
+        """
+        signature = get_db_signature(db_info['db_path'])
+        metadata = app.metadata_cache.get(db_info['db_path'], version=signature)
+        if metadata:
+            return metadata
+
+        tables = await self.metadata_tables(db_info)
+        rows, _ = await self.execute(INDEXED_COLUMNS_SQL, db_info, params=[db_info['table_name']])
+        columns, _ = await self.execute(f"PRAGMA table_info([{db_info['table_name']}])", db_info)
+        search_columns, _ = await self.execute(f"PRAGMA table_info([{search_table(db_info['table_name'])}])", db_info)
+        metadata = {
+            'signature': signature,
+            'table_name': db_info['table_name'],
+            'columns': [(row[1], row[2]) for row in columns],
+            'search_columns': {row[1].lower() for row in search_columns},
+            'indexed_columns': {row[0].lower() for row in rows},
+            'general_infos': self.general_infos(tables),
+            'columns_infos': self.columns_infos(tables),
+            'db_infos': dict(tables['csvapi_infos'][1]) if 'csvapi_infos' in tables else {},
+        }
+        app.metadata_cache.set(db_info['db_path'], metadata, version=signature)
+        return metadata
 
-        return jsonify(res)
-
-    async def general_infos(self, db_info):
-        params = {}
-        sql = 'SELECT count(*) FROM sqlite_master WHERE type=\'table\' AND name=\'general_infos\''
-        rows, description = await self.execute(
-            sql, db_info, params=params
+    async def metadata_tables(self, db_info):
+        """Read every metadata table present in the db, as {table_name: (columns, rows)}"""
+        sql = 'SELECT name FROM sqlite_master WHERE type=\'table\' AND name IN ({})'.format(
+            ', '.join(f"'{name}'" for name in METADATA_TABLES)
         )
-        if rows[0][0] != 0:
-            sql = 'SELECT * FROM general_infos'
-            rows, description = await self.execute(
-                sql, db_info, params=params
-            )
-            columns = [r[0] for r in description]
-            res = {}
-            cpt = 0
-            for col in columns:
-                res[col] = rows[0][cpt]
-                cpt = cpt + 1
-
-            return res
-        else:
+        rows, _ = await self.execute(sql, db_info)
+        tables = {}
+        for (name,) in rows:
+            rows, description = await self.execute(f'SELECT * FROM [{name}]', db_info)
+            tables[name] = ([r[0] for r in description], rows)
+        return tables
+
+    def general_infos(self, tables):
+        if 'general_infos' not in tables:
             return {}
+        columns, rows = tables['general_infos']
+        return dict(zip(columns, rows[0]))
 
-    async def columns_infos(self, db_info):
-        params = {}
-        sql = 'SELECT count(*) FROM sqlite_master WHERE type=\'table\' AND name=\'columns_infos\''
-        rows, description = await self.execute(
-            sql, db_info, params=params
-        )
-        if rows[0][0] != 0:
-            sql = 'SELECT * FROM columns_infos'
-            rows, description = await self.execute(
-                sql, db_info, params=params
-            )
-            columns = [r[0] for r in description]
-
-            res = {}
-            for row in rows:
-                cpt = 1
-                res[row[0]] = {}
-                for col in columns[1:]:
-                    res[row[0]][col] = row[cpt]
-                    cpt = cpt + 1
-
-            res = await self.top_and_categorical_infos(db_info, res, 'top_infos')
-            res = await self.top_and_categorical_infos(db_info, res, 'categorical_infos')
-            res = await self.numeric_infos(db_info, res)
-            res = await self.numeric_plot_infos(db_info, res)
-            return res
-        else:
+    def columns_infos(self, tables):
+        if 'columns_infos' not in tables:
             return {}
-
-    async def top_and_categorical_infos(self, db_info, res, table_name):
-        params = {}
-        sql = 'SELECT count(*) FROM sqlite_master WHERE type=\'table\' AND name=\'{}\''.format(table_name)
-        rows, description = await self.execute(
-            sql, db_info, params=params
-        )
-        if rows[0][0] != 0:
-            sql = 'SELECT * FROM {}'.format(table_name)
-            rows, description = await self.execute(
-                sql, db_info, params=params
-            )
-
-            for row in rows:
-                if table_name not in res[row[0]]:
-                    res[row[0]][table_name] = []
-                inter = {}
-                inter['value'] = row[1]
-                inter['count'] = row[2]
-                res[row[0]][table_name].append(inter)
-
-            return res
-        else:
-            for col in res:
-                res[col][table_name] = {}
-            return res
-
-    async def numeric_infos(self, db_info, res):
-        params = {}
-        sql = 'SELECT count(*) FROM sqlite_master WHERE type=\'table\' AND name=\'numeric_infos\''
-        rows, description = await self.execute(
-            sql, db_info, params=params
-        )
-        if rows[0][0] != 0:
-            sql = 'SELECT * FROM {}'.format('numeric_infos')
-            rows, description = await self.execute(
-                sql, db_info, params=params
-            )
-
-            for row in rows:
-                if 'numeric_infos' not in res[row[0]]:
-                    res[row[0]]['numeric_infos'] = {}
-
-                res[row[0]]['numeric_infos']['mean'] = row[1]
-                res[row[0]]['numeric_infos']['std'] = row[2]
-                res[row[0]]['numeric_infos']['min'] = row[3]
-                res[row[0]]['numeric_infos']['max'] = row[4]
-
-            return res
-        else:
+        columns, rows = tables['columns_infos']
+        res = {row[0]: dict(zip(columns[1:], row[1:])) for row in rows}
+
+        for table_name in ('top_infos', 'categorical_infos'):
+            if table_name not in tables:
+                for col in res:
+                    res[col][table_name] = {}
+                continue
+            for row in tables[table_name][1]:
+                res[row[0]].setdefault(table_name, []).append({'value': row[1], 'count': row[2]})
+
+        if 'numeric_infos' not in tables:
             for col in res:
                 res[col]['numeric_infos'] = {}
-            return res
-
-    async def numeric_plot_infos(self, db_info, res):
-        params = {}
-        sql = 'SELECT count(*) FROM sqlite_master WHERE type=\'table\' AND name=\'numeric_plot_infos\''
-        rows, description = await self.execute(
-            sql, db_info, params=params
-        )
-        if rows[0][0] != 0:
-            sql = 'SELECT * FROM {}'.format('numeric_plot_infos')
-            rows, description = await self.execute(
-                sql, db_info, params=params
-            )
-
-            for row in rows:
-                if 'numeric_plot_infos' not in res[row[0]]:
-                    res[row[0]]['numeric_plot_infos'] = {}
-                if 'counts' not in res[row[0]]['numeric_plot_infos']:
-                    res[row[0]]['numeric_plot_infos']['counts'] = []
-                if 'bin_edges' not in res[row[0]]['numeric_plot_infos']:
-                    res[row[0]]['numeric_plot_infos']['bin_edges'] = []
-                if row[2] == 'counts':
-                    res[row[0]]['numeric_plot_infos']['counts'].append(row[1])
-                if row[2] == 'bin_edges':
-                    res[row[0]]['numeric_plot_infos']['bin_edges'].append(row[1])
-
-            return res
         else:
+            for row in tables['numeric_infos'][1]:
+                res[row[0]]['numeric_infos'] = dict(zip(('mean', 'std', 'min', 'max'), row[1:5]))
+
+        if 'numeric_plot_infos' not in tables:
             for col in res:
                 res[col]['numeric_plot_infos'] = {}
-            return res
+        else:
+            for row in tables['numeric_plot_infos'][1]:
+                plot_infos = res[row[0]].setdefault('numeric_plot_infos', {'counts': [], 'bin_edges': []})
+                if row[2] in plot_infos:
+                    plot_infos[row[2]].append(row[1])
+
+        return res
@@ -17,6 +17,9 @@ from sqlalchemy.types import VARCHAR
 from stdnum.fr.siren import is_valid as is_valid_siren
 from stdnum.fr.siret import is_valid as is_valid_siret
 
+TIME_RE = re.compile(r"^(?:[01]\d|2[0-3]|\d):[0-5]\d$")
+ASCII_DIGIT_RE = re.compile(r"[0-9]")
+
 
 class Time(DataType):
     # Detect an hour minute string.
@@ -27,7 +30,7 @@ class Time(DataType):
     def cast(self, d):
         if d is None:
             return d
-        if re.match(r"^(?:[01]\d|2[0-3]|\d):[0-5]\d$", str(d)):
+        if TIME_RE.match(str(d)):
             return Text().cast(d)
         raise CastError('Can not parse value "%s" as time.' % d)
 
@@ -40,7 +43,9 @@ class SirenSiret(DataType):
     def cast(self, d):
         if d is None:
             return d
-        if is_valid_siret(d) or is_valid_siren(d):
+        # SIREN and SIRET are made of 9 or 14 digits, skip the checksum for anything else
+        if isinstance(d, str) and len(ASCII_DIGIT_RE.findall(d)) in (9, 14) and \
+                (is_valid_siret(d) or is_valid_siren(d)):
             return Text().cast(d)
         raise CastError('Can not parse value "%s" as a SIREN or SIRET.' % d)
 
@@ -54,13 +59,38 @@ agatesqltable.SQL_TYPE_MAP[Time] = VARCHAR
 agatesqltable.SQL_TYPE_MAP[SirenSiret] = VARCHAR
 
 
-def agate_tester():
+class ColumnTypeTester(TypeTester):
+    """
+    Same result as agate's TypeTester, but computed column by column:
+    each type is tested (in order of preference) against the distinct values
+    of the sample and dropped as soon as one value does not fit.
+    """
+
+    def run(self, rows, column_names):
+        if self._limit == 0:
+            return super().run(rows, column_names)
+        sample_rows = rows[:self._limit] if self._limit else rows
+        column_types = []
+        for i, column_name in enumerate(column_names):
+            if column_name in self._force:
+                column_types.append(self._force[column_name])
+                continue
+            values = {row[i] for row in sample_rows if len(row) > i}
+            for column_type in self._possible_types:
+                if all(column_type.test(value) for value in values):
+                    column_types.append(column_type)
+                    break
+        return tuple(column_types)
+
+
+def agate_tester(limit=None):
     # Override the original list of type checkers present in agate
     # to detect types.
     #
     # Original list here:
     # https://github.com/wireservice/agate/blob/e3078dca8b3566e8408e65981f79918c2f36f9fe/agate/type_tester.py#L64-L71
-    return TypeTester(
+    return ColumnTypeTester(
+        limit=limit,
         types=[
             Boolean(),
             SirenSiret(),
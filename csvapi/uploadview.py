@@ -1,33 +1,138 @@
+import asyncio
 import os
 from tempfile import NamedTemporaryFile
 
 from quart import request, current_app as app, jsonify
 from quart.views import MethodView
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
 
 from csvapi.errors import APIError
-from csvapi.utils import get_hash_bytes, already_exists
-from csvapi.parser import parse
+from csvapi.indexes import INDEX_MAX_COLUMNS, INDEX_MIN_ROWS
+from csvapi.ingestion import ingest
+from csvapi.singleflight import file_lock
+from csvapi.utils import already_exists, run_in_executor
+
+# in bytes, uploads are written to disk by blocks of this size (in a thread, not to block the event loop)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# form fields of the uploaded file
+UPLOAD_FIELDS = ('file', 'filepond')
+
+
+def write_block(f, data, hashers):
+    f.write(data)
+    # hashlib releases the GIL on blocks this big: hashing does not block the event loop either
+    for hasher in hashers:
+        hasher.update(data)
+
+
+async def with_end(body):
+    '''Chunks of `body`, then None: the end of the body for `MultipartDecoder.receive_data`'''
+    async for data in body:
+        yield data
+    yield None
+
+
+async def spool_upload(body, boundary, path, new_hashers, chunk_size=UPLOAD_CHUNK_SIZE, max_size=None):
+    '''
+    Write the file of the multipart/form-data `body` to `path` as it is received, hashing it along the way
+    with each of `new_hashers` (in a single pass): memory usage does not depend on the size of the file.
+    Returns its hashes, an empty list if there is no file.
+    Raises an APIError if the body ends before the closing boundary (e.g. the client went away).
+    '''
+    loop = asyncio.get_running_loop()
+    decoder = MultipartDecoder(boundary)
+    hashers = []
+    writing = False
+    event = None
+    size = 0
+    buffer = bytearray()
+    with open(path, 'wb') as f:
+        async for data in with_end(body):
+            decoder.receive_data(data)
+            try:
+                event = decoder.next_event()
+                while not isinstance(event, (Epilogue, NeedData)):
+                    if isinstance(event, (Field, File)):
+                        # only the first file is kept
+                        writing = not hashers and isinstance(event, File) and event.name in UPLOAD_FIELDS
+                        if writing:
+                            hashers = [new_hasher() for new_hasher in new_hashers]
+                    elif isinstance(event, Data) and writing:
+                        size += len(event.data)
+                        if max_size is not None and size > max_size:
+                            raise APIError('File too big (max size is %s bytes)' % max_size, status=413)
+                        buffer += event.data
+                        if len(buffer) >= chunk_size or not event.more_data:
+                            await loop.run_in_executor(None, write_block, f, bytes(buffer), hashers)
+                            buffer.clear()
+                        writing = event.more_data
+                    event = decoder.next_event()
+            except ValueError:
+                # raised by the decoder once the body is complete, if it ends before the closing boundary
+                raise APIError('Malformed upload', status=400)
+    if not isinstance(event, Epilogue):
+        raise APIError('Malformed upload', status=400)
+    return [hasher.hexdigest() for hasher in hashers]
 
 
 class UploadView(MethodView):
 
+    async def legacy_hash(self, legacy_hashes):
+        '''
+        Hash of the file with the former content hashes (LEGACY_CONTENT_HASHES) if it has been parsed already
+        under this name, so that files uploaded before the content hash changed are not parsed again.
+        '''
+        for content_hash in legacy_hashes:
+            if await already_exists(content_hash):
+                return content_hash
+        return None
+
+    async def ingest_once(self, filepath, content_hash):
+        '''Parse an uploaded file, unless the same file has just been parsed by another request (or worker)'''
+        storage = app.config['DB_ROOT_DIR']
+        async with file_lock(f'{storage}/{content_hash}.lock'):
+            if await already_exists(content_hash):
+                return
+            await run_in_executor(
+                ingest, filepath, content_hash, storage,
+                sniff_limit=app.config.get('CSV_SNIFF_LIMIT'),
+                streaming=app.config.get('CSV_STREAMING_PARSE'),
+                encoding_limit=app.config.get('ENCODING_DETECTION_LIMIT'),
+                type_inference_limit=app.config.get('TYPE_INFERENCE_LIMIT'),
+                index_min_rows=app.config.get('INDEX_MIN_ROWS', INDEX_MIN_ROWS),
+                index_max_columns=app.config.get('INDEX_MAX_COLUMNS', INDEX_MAX_COLUMNS),
+                search_index=app.config.get('SEARCH_INDEX', True),
+                max_decompressed_size=app.config.get('MAX_DECOMPRESSED_SIZE'),
+            )
+
     async def post(self):
-        files = await request.files
-        _file = files.get('file') or files.get('filepond')
-        if not _file:
+        boundary = request.mimetype_params.get('boundary')
+        if request.mimetype != 'multipart/form-data' or not boundary:
             raise APIError('Missing file.', status=400)
-        content_hash = get_hash_bytes(_file.read())
-        _file.seek(0)
-        if not already_exists(content_hash):
-            storage = app.config['DB_ROOT_DIR']
-            sniff_limit = app.config.get('CSV_SNIFF_LIMIT')
-            try:
-                _tmpfile = NamedTemporaryFile(delete=False)
-                _file.save(_tmpfile)
-                _tmpfile.close()
-                parse(_tmpfile.name, content_hash, storage, sniff_limit=sniff_limit)
-            finally:
-                os.unlink(_tmpfile.name)
+        _tmpfile = NamedTemporaryFile(delete=False)
+        _tmpfile.close()
+        try:
+            # legacy hashes are only needed to look files up in the cache
+            legacy_hashers = app.legacy_content_hashers if app.config.get('CSV_CACHE_ENABLED') else []
+            hashes = await spool_upload(
+                request.body,
+                boundary.encode(),
+                _tmpfile.name,
+                [app.content_hasher, *legacy_hashers],
+                chunk_size=app.config.get('UPLOAD_CHUNK_SIZE', UPLOAD_CHUNK_SIZE),
+                max_size=app.config.get('MAX_FILE_SIZE'),
+            )
+            if not hashes:
+                raise APIError('Missing file.', status=400)
+            content_hash, legacy_hashes = hashes[0], hashes[1:]
+            if not await already_exists(content_hash):
+                legacy_hash = await self.legacy_hash(legacy_hashes)
+                if legacy_hash:
+                    content_hash = legacy_hash
+                else:
+                    await self.ingest_once(_tmpfile.name, content_hash)
+        finally:
+            os.unlink(_tmpfile.name)
 
         scheme = 'https' if app.config.get('FORCE_SSL') else request.scheme
         return jsonify({
@@ -1,5 +1,11 @@
+import asyncio
+import functools
 import hashlib
+import multiprocessing
+import os
 
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 
 from quart import current_app as app
@@ -8,13 +14,34 @@ import sqlite3
 from datetime import datetime
 import pandas as pd
 
+from csvapi.errors import APIError
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# hashes of file contents -> function returning a new hash object
+CONTENT_HASHES = {
+    'md5': hashlib.md5,
+    # computed by dedicated instructions of recent CPUs (SHA extensions), faster than md5 then
+    'sha256': hashlib.sha256,
+    'blake2b': functools.partial(hashlib.blake2b, digest_size=16),
+    # much faster, but not collision resistant: only if uploads are trusted
+    'xxh3': xxhash.xxh3_128 if xxhash else None,
+}
+# in hexadecimal characters, dbs of uploaded files are named by their content hash truncated to 128 bits
+HASH_LENGTH = 32
+
 executor = None
+# number of jobs submitted to the executor and not finished yet (running or queued)
+pending_jobs = 0
 
 
 def get_db_info(urlhash, storage=None):
-    if app:
-        # app.config not thread safe, sometimes we need to pass storage directly
-        db_storage = storage or app.config['DB_ROOT_DIR']
+    # app.config not thread safe (and not available in executor processes),
+    # sometimes we need to pass storage directly
+    db_storage = storage or app.config['DB_ROOT_DIR']
 
     db_path = f"{db_storage}/{urlhash}.db"
     return {
@@ -25,6 +52,15 @@ def get_db_info(urlhash, storage=None):
     }
 
 
+def get_db_signature(db_path):
+    '''
+    Identify the current version of a db file: it changes whenever the file is written or replaced.
+    Raises FileNotFoundError if the db does not exist.
+    '''
+    stat = os.stat(db_path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
 def get_hash(to_hash):
     return get_hash_bytes(to_hash.encode('utf-8'))
 
@@ -33,6 +69,31 @@ def get_hash_bytes(to_hash):
     return hashlib.md5(to_hash).hexdigest()
 
 
+class ContentHasher:
+    """Incremental hash of a file content, `HASH_LENGTH` hexadecimal characters long like md5 hashes"""
+
+    def __init__(self, new_hash):
+        self.hash = new_hash()
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()[:HASH_LENGTH]
+
+
+def get_content_hasher(name='sha256'):
+    '''
+    Function returning a new `ContentHasher` using the `name` hash, cf `CONTENT_HASHES`.
+    Uploaded files are stored by their content hash.
+    '''
+    if name not in CONTENT_HASHES:
+        raise ValueError(f'Unknown content hash {name}')
+    if CONTENT_HASHES[name] is None:
+        raise ValueError(f'{name} content hash requires xxhash to be installed')
+    return functools.partial(ContentHasher, CONTENT_HASHES[name])
+
+
 async def already_exists(urlhash, analysis=None):
     '''
     Check if db exist. If analysis is requested, we check if general_infos table exist.
@@ -58,12 +119,75 @@ async def already_exists(urlhash, analysis=None):
             return False
 
 
+def get_executor():
+    global executor
+    if executor is None:
+        # workers are not forked from the app process, which runs threads (aiosqlite, executors):
+        # a lock held by one of them when forking would never be released in the child
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        executor = ProcessPoolExecutor(
+            max_workers=app.config.get('MAX_WORKERS'), mp_context=multiprocessing.get_context(start_method)
+        )
+    return executor
+
+
+def shutdown_executor():
+    global executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+        executor = None
+
+
+async def run_in_executor(func, *args, **kwargs):
+    '''
+    Run `func` in the ingestion process pool, without blocking the event loop.
+    At most MAX_WORKERS jobs run at the same time and INGESTION_QUEUE_SIZE jobs
+    can wait for a worker: when the queue is full, we fail fast instead of piling up work.
+    '''
+    global pending_jobs
+    max_pending = app.config.get('MAX_WORKERS') + app.config.get('INGESTION_QUEUE_SIZE', 0)
+    if pending_jobs >= max_pending:
+        raise APIError('Too many files being parsed, please retry later.', status=503)
+    pending_jobs += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+    except BrokenProcessPool:
+        # a worker died (e.g. OOM killed), the pool is unusable: start a fresh one next time
+        shutdown_executor()
+        raise
+    finally:
+        pending_jobs -= 1
+
+
 def create_connection(db_file):
     conn = None
     conn = sqlite3.connect(db_file)
     return conn
 
 
+def set_db_infos(conn, **infos):
+    '''
+    Store csvapi's own infos about the db (e.g. its number of rows) in the `csvapi_infos` key/value table.
+    '''
+    conn.execute('CREATE TABLE IF NOT EXISTS csvapi_infos (key TEXT PRIMARY KEY, value)')
+    conn.executemany('INSERT OR REPLACE INTO csvapi_infos (key, value) VALUES (?, ?)', infos.items())
+    conn.commit()
+
+
+def get_db_infos(db_path):
+    '''Infos stored with `set_db_infos`, empty if the db does not exist (yet)'''
+    if not os.path.exists(db_path):
+        return {}
+    conn = sqlite3.connect(f'file:{db_path}?immutable=1', uri=True)
+    try:
+        return dict(conn.execute('SELECT key, value FROM csvapi_infos'))
+    except sqlite3.DatabaseError:
+        return {}
+    finally:
+        conn.close()
+
+
 def keys_exists(element, *keys):
     '''
     Check if *keys (nested) exists in `element` (dict).
@@ -126,13 +250,15 @@ def df_to_sql(obj, conn, name):
         df.to_sql(name, con=conn, if_exists='replace', index=False)
 
 
-def enrich_db_with_metadata(urlhash, csv_detective_report, profile_report, dataset_id, key):
+def enrich_db_with_metadata(urlhash, csv_detective_report, profile_report, dataset_id, key, storage=None,
+                            encoding_confidence=None):
     # Save to sql
-    conn = create_connection(app.config['DB_ROOT_DIR'] + '/' + urlhash + '.db')
+    conn = create_connection(get_db_info(urlhash, storage=storage)['db_path'])
 
     general_infos = [
         {
             'encoding': csv_detective_report['encoding'],
+            'encoding_confidence': encoding_confidence,
             'separator': csv_detective_report['separator'],
             'header_row_idx': csv_detective_report['header_row_idx'],
             'total_lines': profile_report['table']['n'],
@@ -227,3 +353,4 @@ def enrich_db_with_metadata(urlhash, csv_detective_report, profile_report, datas
     df_to_sql(numeric_plot_infos, conn, 'numeric_plot_infos')
 
     conn.commit()
+    conn.close()
@@ -8,9 +8,19 @@ from werkzeug.exceptions import NotFound
 from csvapi.errors import APIError
 from csvapi.tableview import TableView
 from csvapi.exportview import ExportView
+from csvapi.downloader import Downloader
+from csvapi.indexes import IndexAdvisor
+from csvapi.jobs import JobScheduler
+from csvapi.jobsview import JobsView
 from csvapi.uploadview import UploadView
 from csvapi.parseview import ParseView
+from csvapi.statsview import StatsView
+from csvapi.cache import LRUCache
+from csvapi.pool import ConnectionPool
 from csvapi.security import filter_referrers
+from csvapi.serializers import get_serializer
+from csvapi.singleflight import SingleFlight
+from csvapi.utils import get_content_hasher, shutdown_executor
 
 app = Quart(__name__)
 app = cors(app, allow_origin='*')
@@ -18,13 +28,57 @@ app = cors(app, allow_origin='*')
 app.add_url_rule('/api/<urlhash>', view_func=TableView.as_view('table'))
 app.add_url_rule('/api/<urlhash>/export', view_func=ExportView.as_view('export'))
 app.add_url_rule('/apify', view_func=ParseView.as_view('parse'))
+app.add_url_rule('/jobs/<job_id>', view_func=JobsView.as_view('jobs'))
 app.add_url_rule('/upload', view_func=UploadView.as_view('upload'))
+app.add_url_rule('/stats', view_func=StatsView.as_view('stats'))
 app.before_request(filter_referrers)
+app.after_serving(shutdown_executor)
 
 
 conffile = os.environ.get('CSVAPI_CONFIG_FILE') or '../config.py'
 app.config.from_pyfile(conffile)
 
+app.db_pool = ConnectionPool(
+    size=app.config.get('SQLITE_POOL_SIZE', 4),
+    max_databases=app.config.get('SQLITE_POOL_MAX_DBS', 32),
+)
+app.metadata_cache = LRUCache(app.config.get('METADATA_CACHE_SIZE', 256))
+app.count_cache = LRUCache(app.config.get('COUNT_CACHE_SIZE', 1024))
+app.response_cache = LRUCache(
+    maxsize=app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 10000),
+    max_bytes=app.config.get('RESPONSE_CACHE_MAX_BYTES', 0),
+    ttl=app.config.get('RESPONSE_CACHE_TTL'),
+)
+app.downloader = Downloader(
+    chunk_size=app.config.get('DOWNLOAD_CHUNK_SIZE', 1024 * 1024),
+    pool_size=app.config.get('DOWNLOAD_POOL_SIZE', 100),
+    connect_timeout=app.config.get('DOWNLOAD_CONNECT_TIMEOUT', 30),
+    read_timeout=app.config.get('DOWNLOAD_READ_TIMEOUT', 60),
+)
+app.ingestions = SingleFlight()
+app.jobs = JobScheduler(
+    concurrency=app.config.get('JOBS_CONCURRENCY', 2),
+    queue_size=app.config.get('JOBS_QUEUE_SIZE', 100),
+    history_size=app.config.get('JOBS_HISTORY_SIZE', 1000),
+)
+app.content_hasher = get_content_hasher(app.config.get('CONTENT_HASH', 'sha256'))
+app.legacy_content_hashers = [
+    get_content_hasher(name) for name in app.config.get('LEGACY_CONTENT_HASHES', ['md5'])
+    if name != app.config.get('CONTENT_HASH', 'sha256')
+]
+app.json_dumps = get_serializer(app.config.get('JSON_SERIALIZER', 'auto'))
+app.index_advisor = IndexAdvisor(threshold=app.config.get('INDEX_ACCESS_THRESHOLD', 20))
+
+
+@app.after_serving
+async def close_db_pool():
+    await app.db_pool.close()
+
+
+@app.after_serving
+async def close_downloader():
+    await app.downloader.close()
+
 
 def handle_and_print_error(error):
     sentry_id = None
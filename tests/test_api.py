@@ -1,12 +1,32 @@
+import asyncio
+import bz2
+import gzip
+import io
+import lzma
 import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
 import uuid
+import zipfile
 from pathlib import Path
 
+import agate
 import pytest
 import pytest_asyncio
 from aioresponses import aioresponses
-
-from csvapi.utils import get_hash
+from quart.datastructures import FileStorage
+
+from csvapi import indexes, parser, pipeline, type_tester
+from csvapi.errors import APIError
+from csvapi.indexes import INDEXED_COLUMNS_SQL
+from csvapi.parser import read_csv
+from csvapi.serializers import get_serializer
+from csvapi.singleflight import file_lock, try_file_lock
+from csvapi.type_tester import agate_tester
+from csvapi.utils import get_content_hasher, get_db_signature, get_hash, get_hash_bytes, run_in_executor
 from csvapi.webservice import app as csvapi_app
 
 MOCK_CSV_URL = 'http://domain.com/file.csv'
@@ -35,9 +55,18 @@ def app():
     [db.unlink() for db in Path(DB_ROOT_DIR).glob('*.db')]
 
 
-@pytest.fixture
-def client(app):
+@pytest_asyncio.fixture
+async def client(app):
     yield app.test_client()
+    # the shared HTTP session is bound to the event loop of the test
+    await app.downloader.close()
+
+
+@pytest.fixture(params=[False, True], ids=['agate', 'streaming'])
+def parse_mode(app, request):
+    app.config.update({'CSV_STREAMING_PARSE': request.param})
+    yield request.param
+    app.config.update({'CSV_STREAMING_PARSE': False})
 
 
 @pytest.fixture
@@ -182,7 +211,202 @@ async def test_apify_w_cache(app, rmock, csv, client):
     app.config.update({'CSV_CACHE_ENABLED': False})
 
 
-async def test_apify_col_mismatch(rmock, csv_col_mismatch, client):
+async def test_apify_single_flight(app, rmock, csv, client):
+    url = random_url()
+    # the file can only be downloaded once
+    rmock.get(url, body=csv.replace('<sep>', ';').encode('utf-8'))
+    responses = await asyncio.gather(*[client.get(f"/apify?url={url}") for _ in range(3)])
+    assert [res.status_code for res in responses] == [200, 200, 200]
+    assert len(app.ingestions) == 0
+    assert not Path(f"{DB_ROOT_DIR}/{get_hash(url)}.lock").exists()
+    res = await client.get(f"/api/{get_hash(url)}")
+    assert (await res.json)['total'] == 2
+
+
+async def test_file_lock(tmp_path):
+    path = str(tmp_path / 'file.lock')
+    acquired = []
+
+    async def lock(i):
+        async with file_lock(path):
+            acquired.append(i)
+            await asyncio.sleep(0)
+
+    # held by another worker
+    with try_file_lock(path) as locked:
+        assert locked
+        # more waiters than threads of the default executor
+        waiters = [asyncio.ensure_future(lock(i)) for i in range(40)]
+        await asyncio.sleep(0.2)
+        assert not acquired
+        # waiting for the lock does not hold threads
+        assert await asyncio.wait_for(asyncio.get_running_loop().run_in_executor(None, len, 'free'), 1) == 4
+    await asyncio.gather(*waiters)
+    assert sorted(acquired) == list(range(40))
+    assert not os.path.exists(path)
+
+
+async def test_apify_ingestion_queue_full(app, rmock, csv, client):
+    app.config.update({'INGESTION_QUEUE_SIZE': -app.config['MAX_WORKERS']})
+    rmock.get(MOCK_CSV_URL, body=csv.encode('utf-8'))
+    res = await client.get(f"/apify?url={MOCK_CSV_URL}")
+    app.config.update({'INGESTION_QUEUE_SIZE': 10})
+    assert res.status_code == 503
+    jsonres = await res.json
+    assert not jsonres['ok']
+
+
+def raise_api_error():
+    raise APIError('Not acceptable', status=406, payload={'detail': 'worker'})
+
+
+async def test_executor_api_error(app):
+    async with app.app_context():
+        with pytest.raises(APIError) as excinfo:
+            await run_in_executor(raise_api_error)
+    assert excinfo.value.status == 406
+    assert excinfo.value.to_dict() == {'detail': 'worker', 'error': 'Not acceptable', 'ok': False}
+
+
+async def wait_for_job(client, job_id):
+    for _ in range(200):
+        res = await client.get(f"/jobs/{job_id}")
+        job = (await res.json)['job']
+        if job['status'] in ('done', 'failed'):
+            return job
+        await asyncio.sleep(0.05)
+    raise AssertionError(f'job {job_id} not finished: {job}')
+
+
+async def test_apify_async(rmock, csv, client):
+    url = random_url()
+    body = csv.replace('<sep>', ';').encode('utf-8')
+    rmock.get(url, body=body)
+    res = await client.get(f"/apify?url={url}&async=yes")
+    assert res.status_code == 202
+    jsonres = await res.json
+    assert jsonres['job']['status'] == 'queued'
+    assert f"/api/{get_hash(url)}" in jsonres['endpoint']
+    assert f"/jobs/{jsonres['job']['id']}" in jsonres['job_endpoint']
+    job = await wait_for_job(client, jsonres['job']['id'])
+    assert job['status'] == 'done'
+    assert job['error'] is None
+    assert job['bytes'] == len(body)
+    assert set(job['timings']) == {'queued', 'downloading', 'parsing'}
+    res = await client.get(f"/api/{get_hash(url)}")
+    assert (await res.json)['total'] == 2
+
+
+async def test_apify_async_failed(rmock, client):
+    url = random_url()
+    rmock.get(url, status=404)
+    res = await client.get(f"/apify?url={url}&async=yes")
+    job = await wait_for_job(client, (await res.json)['job']['id'])
+    assert job['status'] == 'failed'
+    assert job['error'].startswith("Error parsing CSV: 404, message='Not Found'")
+
+
+async def test_apify_async_queue_full(app, client):
+    app.jobs.concurrency, app.jobs.queue_size = 0, 0
+    res = await client.get(f"/apify?url={random_url()}&async=yes")
+    app.jobs.concurrency, app.jobs.queue_size = 2, 100
+    assert res.status_code == 503
+
+
+async def test_jobs_not_found(client):
+    res = await client.get("/jobs/nope")
+    assert res.status_code == 404
+
+
+def content_hash(content, name='sha256'):
+    hasher = get_content_hasher(name)()
+    hasher.update(content)
+    return hasher.hexdigest()
+
+
+@pytest.mark.parametrize('hash_name', ['sha256', 'md5', 'blake2b', 'xxh3'])
+async def test_upload(app, client, csv, hash_name):
+    if hash_name == 'xxh3':
+        pytest.importorskip('xxhash')
+    app.content_hasher = get_content_hasher(hash_name)
+    content = csv.replace('<sep>', ';').encode('utf-8')
+    app.config.update({'UPLOAD_CHUNK_SIZE': 16})
+    res = await client.post('/upload', files={'file': FileStorage(io.BytesIO(content), filename='file.csv')})
+    app.config.update({'UPLOAD_CHUNK_SIZE': 1024 * 1024})
+    app.content_hasher = get_content_hasher('sha256')
+    assert res.status_code == 200
+    urlhash = content_hash(content, hash_name)
+    assert len(urlhash) == 32
+    jsonres = await res.json
+    assert jsonres['endpoint'].endswith(f"/api/{urlhash}")
+    res = await client.get(f"/api/{urlhash}")
+    jsonres = await res.json
+    assert jsonres['rows'] == [
+        [1, 'data à1', 'data b1', 'z'],
+        [2, 'data ª2', 'data b2', 'a'],
+    ]
+
+
+async def test_upload_w_cache(app, client, csv):
+    app.config.update({'CSV_CACHE_ENABLED': True})
+    content = csv.replace('<sep>', ';').encode('utf-8')
+    db_path = Path(DB_ROOT_DIR) / f"{content_hash(content)}.db"
+    await client.post('/upload', files={'file': FileStorage(io.BytesIO(content), filename='file.csv')})
+    signature = db_path.stat().st_ino
+    res = await client.post('/upload', files={'filepond': FileStorage(io.BytesIO(content), filename='file.csv')})
+    app.config.update({'CSV_CACHE_ENABLED': False})
+    assert res.status_code == 200
+    # not parsed again
+    assert db_path.stat().st_ino == signature
+
+
+@pytest.mark.parametrize('legacy_hashes', [['md5'], []])
+async def test_upload_legacy_hash(app, client, csv, legacy_hashes):
+    app.config.update({'CSV_CACHE_ENABLED': True})
+    content = csv.replace('<sep>', ';').encode('utf-8')
+    # uploaded when files were named by their md5 hash
+    app.content_hasher = get_content_hasher('md5')
+    await client.post('/upload', files={'file': FileStorage(io.BytesIO(content), filename='file.csv')})
+    app.content_hasher = get_content_hasher('sha256')
+    default_hashers = app.legacy_content_hashers
+    app.legacy_content_hashers = [get_content_hasher(name) for name in legacy_hashes]
+    res = await client.post('/upload', files={'file': FileStorage(io.BytesIO(content), filename='file.csv')})
+    app.legacy_content_hashers = default_hashers
+    app.config.update({'CSV_CACHE_ENABLED': False})
+    urlhash = get_hash_bytes(content) if legacy_hashes else content_hash(content)
+    assert (await res.json)['endpoint'].endswith(f"/api/{urlhash}")
+    assert (Path(DB_ROOT_DIR) / f"{content_hash(content)}.db").exists() == (not legacy_hashes)
+
+
+async def test_upload_no_file(client):
+    res = await client.post('/upload', form={'file': 'not a file'})
+    assert res.status_code == 400
+    res = await client.post('/upload')
+    assert res.status_code == 400
+
+
+async def test_upload_truncated(app, client, csv):
+    content = csv.replace('<sep>', ';').encode('utf-8')
+    body = b'--xxx\r\nContent-Disposition: form-data; name="file"; filename="file.csv"\r\n\r\n' + content
+    headers = {'Content-Type': 'multipart/form-data; boundary=xxx'}
+    res = await client.post('/upload', data=body + b'\r\n--xxx--\r\n', headers=headers)
+    assert res.status_code == 200
+    # the body ends before the closing boundary
+    res = await client.post('/upload', data=body, headers=headers)
+    assert res.status_code == 400
+    assert (await res.json)['error'] == 'Malformed upload'
+
+
+async def test_upload_too_big(app, client, csv):
+    original_max_file_size = app.config.get('MAX_FILE_SIZE')
+    app.config.update({'MAX_FILE_SIZE': 10})
+    content = csv.replace('<sep>', ';').encode('utf-8')
+    res = await client.post('/upload', files={'file': FileStorage(io.BytesIO(content), filename='file.csv')})
+    app.config.update({'MAX_FILE_SIZE': original_max_file_size})
+    assert res.status_code == 413
+
+
+async def test_apify_col_mismatch(rmock, csv_col_mismatch, client, parse_mode):
     rmock.get(MOCK_CSV_URL, body=csv_col_mismatch.replace('<sep>', ';').encode('utf-8'))
     res = await client.get(f"/apify?url={MOCK_CSV_URL}")
     assert res.status_code == 200
@@ -190,7 +414,7 @@ async def test_apify_col_mismatch(rmock, csv_col_mismatch, client):
     assert jsonres['ok']
 
 
-async def test_apify_hour_format(rmock, csv_hour, client):
+async def test_apify_hour_format(rmock, csv_hour, client, parse_mode):
     content = csv_hour.replace('<sep>', ';').encode('utf-8')
     url = random_url()
     rmock.get(url, body=content)
@@ -207,7 +431,7 @@ async def test_apify_hour_format(rmock, csv_hour, client):
     ]
 
 
-async def test_apify_siren_siret_format(rmock, csv_siren_siret, client):
+async def test_apify_siren_siret_format(rmock, csv_siren_siret, client, parse_mode):
     content = csv_siren_siret.replace('<sep>', ';').encode('utf-8')
     url = random_url()
     rmock.get(url, body=content)
@@ -223,7 +447,7 @@ async def test_apify_siren_siret_format(rmock, csv_siren_siret, client):
     ]
 
 
-async def test_apify_custom_types_double_cr(rmock, csv_custom_types_double_cr, client):
+async def test_apify_custom_types_double_cr(rmock, csv_custom_types_double_cr, client, parse_mode):
     content = csv_custom_types_double_cr.replace('<sep>', ';').encode('utf-8')
     url = random_url()
     rmock.get(url, body=content)
@@ -242,9 +466,57 @@ async def test_apify_custom_types_double_cr(rmock, csv_custom_types_double_cr, c
     ]
 
 
+@pytest.mark.parametrize('newline', ['\n', '\r\n', '\r'], ids=['lf', 'crlf', 'cr'])
+async def test_apify_quoted_newlines(rmock, client, parse_mode, newline):
+    content = f'id;text{newline}a;"line 1{newline}line 2"{newline}b;"x"{newline}'.encode('utf-8')
+    url = random_url()
+    rmock.get(url, body=content)
+    await client.get(f"/apify?url={url}")
+    res = await client.get(f"/api/{get_hash(url)}")
+    assert res.status_code == 200
+    # both parsers keep the newlines of quoted values as they are
+    assert (await res.json)['rows'] == [
+        [1, 'a', f'line 1{newline}line 2'],
+        [2, 'b', 'x'],
+    ]
+
+
+@pytest.mark.parametrize('sample,truncated,delimiter,confidence', [
+    ('a;b\n1;2\n3;4\n', True, ';', 1),
+    ('a,b\n1,2\n3,4\n', True, ',', 1),
+    ('id;text\r\na;"line 1\r\nline 2"\r\nb;"x"\r\n', True, ';', 1),
+    # rows with missing values still fit the header
+    ('a,b,c\n1,2,3\n4,5\n6,7,8\n9,10,11\n', True, ',', 2 / 3),
+    # the prefix ends in the middle of a row, which is not taken into account
+    ('a;b\n1;2\n3;4\n5;"6\n7', True, ';', 1),
+    ('a,b,c\n1,2,3\n4,5\n6,7,8\n9,10,11,12,13', True, ',', 2 / 3),
+    # the whole file, its last row is complete
+    ('Nom;Prénom, usuel\nDupont;Jean\n', False, ';', 1),
+])
+async def test_sniff_dialect(sample, truncated, delimiter, confidence):
+    dialect, detected_confidence = parser.sniff_dialect(sample, truncated=truncated)
+    assert dialect.delimiter == delimiter
+    assert detected_confidence == confidence
+
+
+async def test_read_csv_small_file():
+    # shorter than the sniff limit: the last row is taken into account to pick the dialect
+    column_names, rows = read_csv(io.StringIO('Nom;Prénom, usuel\nDupont;Jean\n', newline=''))
+    assert column_names == ('Nom', 'Prénom, usuel')
+    assert list(rows) == [['Dupont', 'Jean']]
+
+
+async def test_read_csv_prefix():
+    content = 'id;text\n' + ''.join(f'{i};"value {i}"\n' for i in range(100))
+    # the prefix ends in a quoted value
+    column_names, rows = read_csv(io.StringIO(content, newline=''), sniff_limit=content.index('value 3') + 2)
+    assert column_names == ('id', 'text')
+    assert list(rows) == [[str(i), f'value {i}'] for i in range(100)]
+
+
 @pytest.mark.parametrize('separator', [';', ',', '\t'])
 @pytest.mark.parametrize('encoding', ['utf-8', 'iso-8859-15', 'iso-8859-1'])
-async def test_api(client, rmock, csv, separator, encoding):
+async def test_api(client, rmock, csv, separator, encoding, parse_mode):
     content = csv.replace('<sep>', separator).encode(encoding)
     rmock.get(MOCK_CSV_URL, body=content)
     await client.get(f"/apify?url={MOCK_CSV_URL}")
@@ -259,6 +531,78 @@ async def test_api(client, rmock, csv, separator, encoding):
     ]
 
 
+async def test_api_reparsed_db(client, rmock, csv, csv_numeric):
+    url = random_url()
+    rmock.get(url, body=csv.replace('<sep>', ';').encode('utf-8'))
+    await client.get(f"/apify?url={url}")
+    res = await client.get(f"/api/{get_hash(url)}")
+    assert (await res.json)['columns'] == ['rowid', 'col a', 'col b', 'col c']
+    # pooled connections to the previous version of the db must not be reused
+    rmock.get(url, body=csv_numeric.replace('<sep>', ';').encode('utf-8'))
+    await client.get(f"/apify?url={url}")
+    res = await client.get(f"/api/{get_hash(url)}")
+    jsonres = await res.json
+    assert jsonres['columns'] == ['rowid', 'id', 'value']
+    assert jsonres['total'] == 3
+    # each parse swaps in a new generation of the db, built aside
+    conn = sqlite3.connect(f"{DB_ROOT_DIR}/{get_hash(url)}.db")
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 2
+    conn.close()
+    assert not list(Path(DB_ROOT_DIR).glob('*.build'))
+
+
+async def test_apify_failed_parse_keeps_db(client, rmock, csv):
+    url = random_url()
+    rmock.get(url, body=csv.replace('<sep>', ';').encode('utf-8'))
+    await client.get(f"/apify?url={url}")
+    rmock.get(url, body=b'\x00\x01\x02 not a csv')
+    res = await client.get(f"/apify?url={url}")
+    assert res.status_code == 500
+    # the previous version of the db is still served
+    res = await client.get(f"/api/{get_hash(url)}")
+    assert (await res.json)['columns'] == ['rowid', 'col a', 'col b', 'col c']
+    assert not list(Path(DB_ROOT_DIR).glob('*.build'))
+
+
+async def test_api_http_cache(client, rmock, csv, csv_numeric):
+    url = random_url()
+    rmock.get(url, body=csv.replace('<sep>', ';').encode('utf-8'))
+    await client.get(f"/apify?url={url}")
+    res = await client.get(f"/api/{get_hash(url)}?_size=1&_shape=objects")
+    assert res.status_code == 200
+    etag = res.headers['ETag']
+    assert 'max-age=' in res.headers['Cache-Control']
+    # query arguments order does not matter
+    res = await client.get(f"/api/{get_hash(url)}?_shape=objects&_size=1", headers={'If-None-Match': etag})
+    assert res.status_code == 304
+    assert res.headers['ETag'] == etag
+    assert await res.get_data() == b''
+    res = await client.get(f"/api/{get_hash(url)}?_size=2", headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    res = await client.get(f"/api/{get_hash(url)}/export", headers={'If-Modified-Since': res.headers['Last-Modified']})
+    assert res.status_code == 304
+    # parsed again
+    rmock.get(url, body=csv_numeric.replace('<sep>', ';').encode('utf-8'))
+    await client.get(f"/apify?url={url}")
+    res = await client.get(f"/api/{get_hash(url)}?_size=1&_shape=objects", headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+
+
+async def test_api_response_cache(app, client, rmock, uploaded_csv):
+    res = await client.get("/stats")
+    stats = (await res.json)['caches']['responses']
+    res = await client.get(f"/api/{MOCK_CSV_HASH}?_size=1&_rowid=hide")
+    first = await res.get_data()
+    res = await client.get(f"/api/{MOCK_CSV_HASH}?_rowid=hide&_size=1")
+    assert await res.get_data() == first
+    res = await client.get("/stats")
+    new_stats = (await res.json)['caches']['responses']
+    assert new_stats['misses'] == stats['misses'] + 1
+    assert new_stats['hits'] == stats['hits'] + 1
+    assert new_stats['bytes'] >= len(first)
+
+
 async def test_api_limit(client, rmock, uploaded_csv):
     res = await client.get(f"/api/{MOCK_CSV_HASH}?_size=1")
     assert res.status_code == 200
@@ -308,6 +652,25 @@ async def test_api_objects_shape(client, rmock, uploaded_csv):
     ]
 
 
+@pytest.mark.parametrize('serializer', ['json', 'orjson'])
+async def test_api_serializers(app, client, rmock, uploaded_csv, serializer):
+    if serializer == 'orjson':
+        pytest.importorskip('orjson')
+    json_dumps = app.json_dumps
+    app.json_dumps = get_serializer(serializer)
+    try:
+        res = await client.get(f"/api/{MOCK_CSV_HASH}?_shape=objects&_rowid=hide")
+    finally:
+        app.json_dumps = json_dumps
+    assert res.status_code == 200
+    assert res.mimetype == 'application/json'
+    jsonres = await res.json
+    assert jsonres['rows'] == [
+        {'col a': 'data à1', 'col b': 'data b1', 'col c': 'z'},
+        {'col a': 'data ª2', 'col b': 'data b2', 'col c': 'a'},
+    ]
+
+
 async def test_api_objects_norowid(client, rmock, uploaded_csv):
     res = await client.get(f"/api/{MOCK_CSV_HASH}?_shape=objects&_rowid=hide")
     assert res.status_code == 200
@@ -332,6 +695,28 @@ async def test_api_objects_nototal(client, rmock, uploaded_csv):
     assert jsonres.get('total') is None
 
 
+async def test_api_total_cached(app, rmock, uploaded_csv_filters, client):
+    misses = app.count_cache.misses
+    for _ in range(2):
+        res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?id__contains=fir")
+        assert (await res.json)['total'] == 1
+    # unfiltered totals are stored at parse time, the filtered total is only counted once
+    assert app.count_cache.misses == misses + 1
+
+
+async def test_api_total_estimate(app, rmock, uploaded_csv_filters, client):
+    app.config.update({'TOTAL_ESTIMATE_SAMPLE': 1})
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?id__contains=fir&_total=estimate")
+    jsonres = await res.json
+    assert jsonres['total_estimated'] is True
+    assert jsonres['total'] == 3
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?_total=estimate")
+    jsonres = await res.json
+    assert jsonres['total'] == 3
+    assert 'total_estimated' not in jsonres
+    app.config.update({'TOTAL_ESTIMATE_SAMPLE': 100000})
+
+
 async def test_api_sort(client, rmock, uploaded_csv):
     res = await client.get(f"/api/{MOCK_CSV_HASH}?_sort=col c")
     assert res.status_code == 200
@@ -352,6 +737,122 @@ async def test_api_sort_desc(client, rmock, uploaded_csv):
     ]
 
 
+@pytest.mark.parametrize('sort', ['', '&_sort=value', '&_sort_desc=value', '&_sort_desc=hour'])
+async def test_api_next(rmock, uploaded_csv_filters, client, sort):
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?_size=3{sort}")
+    expected = (await res.json)['rows']
+    rows = []
+    query = f"/api/{MOCK_CSV_HASH_FILTERS}?_size=1{sort}"
+    res = await client.get(query)
+    while True:
+        jsonres = await res.json
+        rows += jsonres['rows']
+        if 'next' not in jsonres:
+            break
+        res = await client.get(f"{query}&_next={jsonres['next']}")
+    assert rows == expected
+    assert len(rows) == 3
+
+
+async def test_api_next_filters_norowid(rmock, uploaded_csv_filters, client):
+    query = f"/api/{MOCK_CSV_HASH_FILTERS}?_size=1&_rowid=hide&value__greater=2"
+    res = await client.get(query)
+    jsonres = await res.json
+    assert jsonres['rows'] == [['second', '9:15', 2.0, 'value']]
+    res = await client.get(f"{query}&_next={jsonres['next']}")
+    jsonres = await res.json
+    assert jsonres['rows'] == [['third', '09:45', 3.0, 'value']]
+
+
+async def test_api_wrong_next(rmock, uploaded_csv_filters, client):
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?_next=wrong")
+    assert res.status_code == 400
+
+
+async def test_api_export(app, rmock, uploaded_csv_filters, client):
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export")
+    assert res.status_code == 200
+    assert res.mimetype == 'text/csv'
+    assert (await res.get_data()).decode() == (
+        'id,hour,value,another column\r\n'
+        'first,12:30,1.0,value\r\n'
+        'second,9:15,2.0,value\r\n'
+        'third,09:45,3.0,value\r\n'
+    )
+
+
+async def test_api_export_batches(app, rmock, uploaded_csv_filters, client):
+    app.config.update({'EXPORT_BATCH_SIZE': 1, 'EXPORT_CHUNK_SIZE': 1})
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export?_sort_desc=value&value__greater=2")
+    app.config.update({'EXPORT_BATCH_SIZE': 1000, 'EXPORT_CHUNK_SIZE': 64 * 1024})
+    assert res.status_code == 200
+    assert (await res.get_data()).decode() == (
+        'id,hour,value,another column\r\n'
+        'third,09:45,3.0,value\r\n'
+        'second,9:15,2.0,value\r\n'
+    )
+
+
+async def test_api_export_ndjson(rmock, uploaded_csv_filters, client):
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export?_format=ndjson&value__less=2")
+    assert res.status_code == 200
+    assert res.mimetype == 'application/x-ndjson'
+    assert (await res.get_data()).decode() == (
+        '{"id": "first", "hour": "12:30", "value": 1.0, "another column": "value"}\n'
+        '{"id": "second", "hour": "9:15", "value": 2.0, "another column": "value"}\n'
+    )
+
+
+@pytest.mark.parametrize('_format', ['parquet', 'arrow'])
+async def test_api_export_arrow(app, rmock, uploaded_csv_filters, client, _format):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    app.config.update({'EXPORT_BATCH_SIZE': 2})
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export?_format={_format}&_sort_desc=value")
+    app.config.update({'EXPORT_BATCH_SIZE': 1000})
+    assert res.status_code == 200
+    data = pa.BufferReader(await res.get_data())
+    table = pq.read_table(data) if _format == 'parquet' else pa.ipc.open_stream(data).read_all()
+    assert table.schema.field('value').type == pa.float64()
+    assert table.to_pydict() == {
+        'id': ['third', 'second', 'first'],
+        'hour': ['09:45', '9:15', '12:30'],
+        'value': [3.0, 2.0, 1.0],
+        'another column': ['value', 'value', 'value'],
+    }
+
+
+async def test_api_export_xlsx(rmock, uploaded_csv_filters, client):
+    from io import BytesIO
+    from openpyxl import load_workbook
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export?_format=xlsx&id__exact=second")
+    assert res.status_code == 200
+    sheet = load_workbook(BytesIO(await res.get_data())).active
+    assert list(sheet.values) == [('id', 'hour', 'value', 'another column'), ('second', '9:15', 2, 'value')]
+
+
+async def test_api_export_xlsx_too_many_rows(app, rmock, uploaded_csv_filters, client, monkeypatch):
+    # a header and two rows
+    monkeypatch.setattr('csvapi.exportview.XLSX_MAX_ROWS', 3)
+    app.config.update({'EXPORT_BATCH_SIZE': 2})
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export?_format=xlsx")
+    assert res.status_code == 400
+    assert 'Too many rows' in (await res.json)['error']
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export?_format=xlsx&value__greater=2")
+    app.config.update({'EXPORT_BATCH_SIZE': 1000})
+    assert res.status_code == 200
+
+
+async def test_api_export_wrong_format(rmock, uploaded_csv_filters, client):
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export?_format=pdf")
+    assert res.status_code == 400
+
+
+async def test_api_export_wrong_sort(rmock, uploaded_csv_filters, client):
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}/export?_sort=nope")
+    assert res.status_code == 400
+
+
 async def test_apify_file_too_big(app, client, rmock):
     original_max_file_size = app.config.get('MAX_FILE_SIZE')
     app.config.update({'MAX_FILE_SIZE': 1})
@@ -367,6 +868,208 @@ async def test_apify_file_too_big(app, client, rmock):
     app.config.update({'MAX_FILE_SIZE': original_max_file_size})
 
 
+async def test_apify_file_too_big_content_length(app, client, rmock):
+    original_max_file_size = app.config.get('MAX_FILE_SIZE')
+    app.config.update({'MAX_FILE_SIZE': 10})
+    rejected = app.downloader.rejected
+    rmock.get(MOCK_CSV_URL, body=b'a;b\n1;2\n', headers={'Content-Length': '1000000'})
+    res = await client.get(f"/apify?url={MOCK_CSV_URL}")
+    app.config.update({'MAX_FILE_SIZE': original_max_file_size})
+    assert res.status_code == 500
+    assert 'File too big' in (await res.json)['error']
+    assert app.downloader.rejected == rejected + 1
+
+
+async def test_apify_not_modified(app, client, rmock, csv):
+    url = random_url()
+    rmock.get(url, body=csv.replace('<sep>', ';').encode('utf-8'), headers={'ETag': '"v1"'})
+    await client.get(f"/apify?url={url}")
+    rmock.get(url, status=304)
+    res = await client.get(f"/apify?url={url}")
+    assert res.status_code == 200
+    # the second download is conditional, and the db is kept as it is
+    requests = [call for (method, req_url), calls in rmock.requests.items() if str(req_url) == url for call in calls]
+    assert requests[1].kwargs['headers']['If-None-Match'] == '"v1"'
+    conn = sqlite3.connect(f"{DB_ROOT_DIR}/{get_hash(url)}.db")
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == 1
+    conn.close()
+    res = await client.get('/stats')
+    assert (await res.json)['downloads']['not_modified'] >= 1
+
+
+async def test_apify_other_encoding(app, client, rmock, csv):
+    url = random_url()
+    content = csv.replace('<sep>', ';').encode('utf-8')
+    rmock.get(url, body=content, headers={'ETag': '"v1"'})
+    await client.get(f"/apify?url={url}")
+    rmock.get(url, body=content, headers={'ETag': '"v1"'})
+    res = await client.get(f"/apify?url={url}&encoding=latin-1")
+    assert res.status_code == 200
+    # not a conditional download: the db has been decoded with another encoding
+    requests = [call for (method, req_url), calls in rmock.requests.items() if str(req_url) == url for call in calls]
+    assert 'If-None-Match' not in requests[1].kwargs['headers']
+    res = await client.get(f"/api/{get_hash(url)}")
+    # decoded as latin-1 as asked, not from the previous db
+    assert (await res.json)['rows'][0][1] == 'data Ã\xa01'
+
+
+@pytest.fixture
+def pipelined(app):
+    app.config.update({'PIPELINED_PARSE': True})
+    yield
+    app.config.update({'PIPELINED_PARSE': False})
+
+
+async def test_apify_pipelined(client, rmock, csv, parse_mode, pipelined):
+    url = random_url()
+    rmock.get(url, body=csv.replace('<sep>', ';').encode('utf-8'))
+    res = await client.get(f"/apify?url={url}")
+    assert res.status_code == 200
+    res = await client.get(f"/api/{get_hash(url)}")
+    jsonres = await res.json
+    assert jsonres['columns'] == ['rowid', 'col a', 'col b', 'col c']
+    assert jsonres['total'] == 2
+
+
+@pytest.mark.parametrize('extension', ['xls', 'xlsx'])
+async def test_apify_pipelined_excel(client, rmock, extension, pipelined):
+    here = os.path.dirname(os.path.abspath(__file__))
+    url = random_url()
+    with open(f"{here}/samples/test.{extension}", 'rb') as f:
+        rmock.get(url, body=f.read())
+    await client.get(f"/apify?url={url}")
+    res = await client.get(f"/api/{get_hash(url)}")
+    assert (await res.json)['rows'] == [[1, 'a1', 'b1', 'z'], [2, 'a2', 'b2', 'a']]
+
+
+async def test_apify_pipelined_file_too_big(app, client, rmock, csv, pipelined):
+    original_max_file_size = app.config.get('MAX_FILE_SIZE')
+    app.config.update({'MAX_FILE_SIZE': 10})
+    url = random_url()
+    rmock.get(url, body=csv.replace('<sep>', ';').encode('utf-8'))
+    res = await client.get(f"/apify?url={url}")
+    app.config.update({'MAX_FILE_SIZE': original_max_file_size})
+    assert res.status_code == 500
+    assert 'File too big' in (await res.json)['error']
+    assert not Path(f"{DB_ROOT_DIR}/{get_hash(url)}.db").exists()
+
+
+def write_slowly(path, chunks, mark, delay=0.05):
+    with open(path, 'ab') as f:
+        for chunk in chunks:
+            time.sleep(delay)
+            f.write(chunk)
+            f.flush()
+    time.sleep(delay)
+    mark(path)
+
+
+@pytest.mark.parametrize('mode', ['rb', 'r'])
+async def test_followed_file(tmp_path, mode):
+    path = str(tmp_path / 'download')
+    open(path, 'wb').close()
+    chunks = [b'id;value\n', b'a;1\nb;', b'2\n']
+    writer = threading.Thread(target=write_slowly, args=(path, chunks, pipeline.mark_download_complete))
+    writer.start()
+    with pipeline.open_followed(path, mode=mode, encoding='utf-8') as f:
+        # waits for the data to come until the download is complete
+        content = f.read()
+    writer.join()
+    assert content == (b''.join(chunks) if mode == 'rb' else 'id;value\na;1\nb;2\n')
+
+
+async def test_followed_file_seek_end(tmp_path):
+    path = str(tmp_path / 'download')
+    open(path, 'wb').close()
+    writer = threading.Thread(target=write_slowly, args=(path, [b'abc', b'def'], pipeline.mark_download_complete))
+    writer.start()
+    with pipeline.open_followed(path, mode='rb') as f:
+        # e.g. spreadsheets, read from their end
+        assert f.seek(0, io.SEEK_END) == 6
+    writer.join()
+
+
+async def test_followed_file_failed(tmp_path):
+    path = str(tmp_path / 'download')
+    open(path, 'wb').close()
+    chunks = [b'id;value\n', b'a;1\n']
+    writer = threading.Thread(target=write_slowly, args=(path, chunks, pipeline.mark_download_failed))
+    writer.start()
+    with pipeline.open_followed(path, mode='rb') as f:
+        assert f.read(9) == b'id;value\n'
+        # stopped while waiting for more data
+        with pytest.raises(pipeline.DownloadFailed):
+            f.read()
+    writer.join()
+
+
+async def test_followed_file_timeout(tmp_path):
+    path = str(tmp_path / 'download')
+    with open(path, 'wb') as f:
+        f.write(b'id;value\n')
+    with pipeline.FollowedFile(path, timeout=0.2, poll_interval=0.05) as f:
+        assert f.read(9) == b'id;value\n'
+        with pytest.raises(TimeoutError):
+            f.read(9)
+    with pytest.raises(TimeoutError):
+        pipeline.wait_for_download(path, timeout=0.2, poll_interval=0.05)
+
+
+def compress(content, compression):
+    if compression == 'zip':
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('readme.md', 'not this one')
+            archive.writestr('data/file.csv', content)
+        return buffer.getvalue()
+    return {'gzip': gzip, 'bz2': bz2, 'xz': lzma}[compression].compress(content)
+
+
+@pytest.mark.parametrize('compression', ['gzip', 'bz2', 'xz', 'zip'])
+async def test_apify_compressed(client, rmock, csv, parse_mode, compression):
+    url = random_url()
+    rmock.get(url, body=compress(csv.replace('<sep>', ';').encode('utf-8'), compression))
+    res = await client.get(f"/apify?url={url}")
+    assert res.status_code == 200
+    res = await client.get(f"/api/{get_hash(url)}")
+    jsonres = await res.json
+    assert jsonres['columns'] == ['rowid', 'col a', 'col b', 'col c']
+    assert jsonres['rows'] == [
+        [1, 'data à1', 'data b1', 'z'],
+        [2, 'data ª2', 'data b2', 'a'],
+    ]
+
+
+@pytest.mark.parametrize('extension', ['xls', 'xlsx'])
+async def test_apify_gzip_content_encoding_excel(client, rmock, extension):
+    here = os.path.dirname(os.path.abspath(__file__))
+    url = random_url()
+    with open(f"{here}/samples/test.{extension}", 'rb') as f:
+        rmock.get(url, body=gzip.compress(f.read()), headers={'Content-Encoding': 'gzip'})
+    res = await client.get(f"/apify?url={url}")
+    assert res.status_code == 200
+    res = await client.get(f"/api/{get_hash(url)}")
+    assert (await res.json)['rows'] == [[1, 'a1', 'b1', 'z'], [2, 'a2', 'b2', 'a']]
+
+
+async def test_apify_compressed_unsupported(client, rmock, csv):
+    url = random_url()
+    rmock.get(url, body=gzip.compress(compress(csv.encode('utf-8'), 'zip')))
+    res = await client.get(f"/apify?url={url}")
+    assert res.status_code == 500
+    assert 'Unsupported compressed file type' in (await res.json)['error']
+
+
+async def test_apify_decompressed_too_big(app, client, rmock, csv):
+    app.config.update({'MAX_DECOMPRESSED_SIZE': 10})
+    url = random_url()
+    rmock.get(url, body=compress(csv.replace('<sep>', ';').encode('utf-8'), 'gzip'))
+    res = await client.get(f"/apify?url={url}")
+    app.config.update({'MAX_DECOMPRESSED_SIZE': 1024 * 1024 * 1024})
+    assert res.status_code == 500
+    assert 'Decompressed file too big' in (await res.json)['error']
+
+
 @pytest.mark.parametrize('extension', ['xls', 'xlsx'])
 async def test_api_excel(client, rmock, extension):
     here = os.path.dirname(os.path.abspath(__file__))
@@ -398,7 +1101,7 @@ async def test_api_filter_referrers(app, client):
 
 
 @pytest.mark.parametrize('csv_path', Path(__file__).parent.glob('samples/real_csv/*.csv'))
-async def test_real_csv_files(client, rmock, csv_path):
+async def test_real_csv_files(client, rmock, csv_path, parse_mode):
     with open(csv_path, 'rb') as content:
         rmock.get(MOCK_CSV_URL, body=content.read())
     res = await client.get(f"/apify?url={MOCK_CSV_URL}")
@@ -425,6 +1128,64 @@ async def test_real_xls_files(client, rmock, xls_path):
     assert len(jsonres['rows']) > 0
 
 
+@pytest.mark.parametrize('fixture', [
+    'csv', 'csv_col_mismatch', 'csv_hour', 'csv_filters', 'csv_siren_siret', 'csv_numeric', 'csv_top',
+    'csv_custom_types_double_cr', 'real_csv',
+])
+async def test_column_type_tester(request, fixture):
+    if fixture == 'real_csv':
+        content = next(Path(__file__).parent.glob('samples/real_csv/*.csv')).read_text(encoding='utf-8')
+    else:
+        content = request.getfixturevalue(fixture).replace('<sep>', ';')
+    column_names, rows = read_csv(io.StringIO(content, newline=''))
+    rows = list(rows)
+    tester = agate_tester()
+    expected = agate.TypeTester(types=tester._possible_types).run(rows, column_names)
+    assert tester.run(rows, column_names) == expected
+
+
+async def test_from_csv_type_inference_limit(tmp_path):
+    csv_path = tmp_path / 'file.csv'
+    csv_path.write_text('id;value\na;1\nb;2\nc;not a number\n', encoding='utf-8')
+    table = parser.from_csv(str(csv_path), type_inference_limit=2)
+    # the value after the sample does not fit, types are inferred again on every row
+    assert isinstance(table.column_types[1], agate.Text)
+    assert list(table.columns['value']) == ['1', '2', 'not a number']
+
+
+@pytest.mark.parametrize('sample_size', [parser.TYPE_INFERENCE_LIMIT, None])
+async def test_stream_csv_to_sql_sample_size(tmp_path, sample_size):
+    csv_path = tmp_path / 'file.csv'
+    nb_numbers = parser.TYPE_INFERENCE_LIMIT + 1
+    csv_path.write_text('value\n' + '12\n' * nb_numbers + 'not a number\n', encoding='utf-8')
+    parser.stream_csv_to_sql(str(csv_path), 'sample', str(tmp_path), sample_size=sample_size)
+    conn = sqlite3.connect(tmp_path / 'sample.db')
+    (sql_type,) = conn.execute('SELECT type FROM pragma_table_info(?)', ['sample']).fetchone()
+    values = [row[0] for row in conn.execute('SELECT value FROM sample')]
+    conn.close()
+    # None infers types on every row
+    assert sql_type == ('FLOAT' if sample_size else 'VARCHAR')
+    assert values == ([12.0] * nb_numbers if sample_size else ['12'] * nb_numbers) + ['not a number']
+
+
+@pytest.mark.parametrize('value,valid', [
+    ('130025265', True),
+    ('13002526500013', True),
+    ('130 025 265', True),
+    ('130025266', False),
+    ('1300252650', False),
+    ('13002526a5', False),
+])
+async def test_siren_siret(monkeypatch, value, valid):
+    checked = []
+    for name in ('is_valid_siren', 'is_valid_siret'):
+        is_valid = getattr(type_tester, name)
+        monkeypatch.setattr(type_tester, name, lambda d, is_valid=is_valid: checked.append(d) or is_valid(d))
+    assert type_tester.SirenSiret().test(value) == valid
+    # checksums are only computed for values of 9 or 14 digits
+    assert bool(checked) == (len(re.sub(r'\D', '', value)) in (9, 14))
+
+
 @pytest_asyncio.fixture
 async def uploaded_csv_filters(rmock, csv_filters, client):
     content = csv_filters.encode('utf-8')
@@ -432,6 +1193,101 @@ async def uploaded_csv_filters(rmock, csv_filters, client):
     await client.get(f"/apify?url={MOCK_CSV_URL_FILTERS}")
 
 
+def get_indexed_columns(urlhash):
+    conn = sqlite3.connect(f"{DB_ROOT_DIR}/{urlhash}.db")
+    try:
+        return {row[0] for row in conn.execute(INDEXED_COLUMNS_SQL, [urlhash])}
+    finally:
+        conn.close()
+
+
+async def test_apify_indexes(app, rmock, csv_filters, client):
+    app.config.update({'INDEX_MIN_ROWS': 1})
+    rmock.get(MOCK_CSV_URL_FILTERS, body=csv_filters.encode('utf-8'))
+    await client.get(f"/apify?url={MOCK_CSV_URL_FILTERS}")
+    app.config.update({'INDEX_MIN_ROWS': 10000})
+    # constant column is not worth an index
+    assert get_indexed_columns(MOCK_CSV_HASH_FILTERS) == {'id', 'hour', 'value'}
+
+
+async def test_api_index_on_access(app, rmock, csv_filters, client):
+    app.config.update({'INDEX_MIN_ROWS': 1, 'INDEX_MAX_COLUMNS': 0})
+    app.index_advisor.threshold = 2
+    rmock.get(MOCK_CSV_URL_FILTERS, body=csv_filters.encode('utf-8'))
+    await client.get(f"/apify?url={MOCK_CSV_URL_FILTERS}")
+    assert get_indexed_columns(MOCK_CSV_HASH_FILTERS) == set()
+    for size in range(1, 3):
+        # column names are case insensitive, indexes are built on the actual column
+        res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?another column__exact=value&_sort=ID&_size={size}")
+        assert res.status_code == 200
+    await asyncio.gather(*[task for task in app.background_tasks if not task.done()])
+    app.config.update({'INDEX_MIN_ROWS': 10000, 'INDEX_MAX_COLUMNS': 8})
+    app.index_advisor.threshold = 20
+    assert get_indexed_columns(MOCK_CSV_HASH_FILTERS) == {'another column', 'id'}
+    res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?another column__exact=value&_sort=id")
+    assert (await res.json)['total'] == 3
+
+
+def create_db(tmp_path, name):
+    db_path = str(tmp_path / f'{name}.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute(f'CREATE TABLE [{name}] (name VARCHAR)')
+    conn.close()
+    return db_path
+
+
+@pytest.mark.parametrize('parsed_again', [False, True])
+async def test_add_indexes(tmp_path, parsed_again):
+    db_path = create_db(tmp_path, 'indexed')
+    signature = get_db_signature(db_path)
+    if parsed_again:
+        os.replace(shutil.copyfile(db_path, f'{db_path}.new'), db_path)
+    assert indexes.add_indexes(db_path, 'indexed', ['name'], signature) != parsed_again
+    assert os.listdir(tmp_path) == ['indexed.db']
+
+
+async def test_add_indexes_while_parsing(tmp_path):
+    db_path = create_db(tmp_path, 'indexed')
+    # held by the ingestion of the same file
+    with try_file_lock(str(tmp_path / 'indexed.lock')) as locked:
+        assert locked
+        assert not indexes.add_indexes(db_path, 'indexed', ['name'], get_db_signature(db_path))
+    assert os.listdir(tmp_path) == ['indexed.db']
+
+
+@pytest.mark.parametrize('index_min_rows', [1, 10000], ids=['search_index', 'like'])
+async def test_api_search(app, rmock, csv_filters, client, index_min_rows):
+    app.config.update({'INDEX_MIN_ROWS': index_min_rows})
+    rmock.get(MOCK_CSV_URL_FILTERS, body=csv_filters.encode('utf-8'))
+    await client.get(f"/apify?url={MOCK_CSV_URL_FILTERS}")
+    app.config.update({'INDEX_MIN_ROWS': 10000})
+    conn = sqlite3.connect(f"{DB_ROOT_DIR}/{MOCK_CSV_HASH_FILTERS}.db")
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    conn.close()
+    assert (f"{MOCK_CSV_HASH_FILTERS}_fts" in tables) == (index_min_rows == 1)
+
+    async def search(query):
+        res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?{query}")
+        assert res.status_code == 200
+        return [row[1] for row in (await res.json)['rows']]
+
+    assert await search('id__contains=ECO') == ['second']
+    assert await search('_search=VALU') == ['first', 'second', 'third']
+    assert await search('_search=ir&_sort_desc=id') == ['third', 'first']
+    assert await search('_search=ird&id__contains=fir') == []
+    assert await search('_search="') == []
+
+
+async def test_search_index_unavailable(monkeypatch, tmp_path):
+    # e.g. SQLite built without FTS5, or older than 3.34 (no trigram tokenizer)
+    monkeypatch.setattr(indexes, 'SEARCH_TOKENIZER', 'unknown')
+    db_path = str(tmp_path / 'search.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE search (name VARCHAR)')
+    conn.close()
+    assert indexes.create_search_index(db_path, 'search', 1, min_rows=1) == []
+
+
 async def test_api_filters_exact_hour(rmock, uploaded_csv_filters, client):
     res = await client.get(f"/api/{MOCK_CSV_HASH_FILTERS}?hour__exact=12:30")
     assert res.status_code == 200
@@ -483,7 +1339,7 @@ async def test_api_and_filters(rmock, uploaded_csv_filters, client):
     ]
 
 
-async def test_api_filters_greater_float(rmock, csv_numeric, client):
+async def test_api_filters_greater_float(rmock, csv_numeric, client, parse_mode):
     content = csv_numeric.replace('<sep>', ';').encode('utf-8')
     url = random_url()
     rmock.get(url, body=content)
@@ -557,6 +1413,7 @@ async def test_apify_analysed_format_response(rmock, csv_siren_siret, client):
         'dataset_id',
         'date_last_check',
         'encoding',
+        'encoding_confidence',
         'header_row_idx',
         'nb_cells_missing',
         'nb_columns',
@@ -569,6 +1426,52 @@ async def test_apify_analysed_format_response(rmock, csv_siren_siret, client):
     ])
 
 
+async def test_apify_analysed_compressed(rmock, csv_siren_siret, client, pipelined):
+    content = csv_siren_siret.replace('<sep>', ';').encode('utf-8')
+    url = random_url()
+    rmock.get(url, body=compress(content, 'gzip'))
+    await client.get(f"/apify?url={url}&analysis=yes")
+    res = await client.get(f"/api/{get_hash(url)}")
+    assert res.status_code == 200
+    jsonres = await res.json
+    assert all(x in jsonres['columns_infos'] for x in ['id', 'siren', 'siret'])
+    assert jsonres['general_infos']['separator'] == ';'
+    assert not list(Path(DB_ROOT_DIR).glob('.*.build'))
+
+
+async def test_apify_encoding_detected_on_sample(app, rmock, client):
+    app.config.update({'ENCODING_DETECTION_LIMIT': 64})
+    # the first 64 bytes are ASCII, the accents come later
+    content = ('id;value\n' + 'a;b\n' * 20 + 'é;à\n').encode('iso-8859-1')
+    url = random_url()
+    rmock.get(url, body=content)
+    await client.get(f"/apify?url={url}&analysis=yes")
+    app.config.update({'ENCODING_DETECTION_LIMIT': 1024 * 1024})
+    res = await client.get(f"/api/{get_hash(url)}?_size=1&_sort_desc=rowid")
+    assert res.status_code == 200
+    jsonres = await res.json
+    assert jsonres['rows'] == [[21, 'é', 'à']]
+    assert 0 < jsonres['general_infos']['encoding_confidence'] <= 1
+
+
+async def test_api_metadata_cache(app, rmock, csv_numeric, csv_top, client):
+    url = random_url()
+    rmock.get(url, body=csv_numeric.replace('<sep>', ';').encode('utf-8'))
+    await client.get(f"/apify?url={url}&analysis=yes")
+    await client.get(f"/api/{get_hash(url)}")
+    misses = app.metadata_cache.misses
+    res = await client.get(f"/api/{get_hash(url)}?_size=1")
+    assert app.metadata_cache.misses == misses
+    assert 'value' in (await res.json)['columns_infos']
+    # metadata is read again once the db has been parsed again
+    rmock.get(url, body=csv_top.replace('<sep>', ';').encode('utf-8'))
+    await client.get(f"/apify?url={url}&analysis=yes")
+    res = await client.get(f"/api/{get_hash(url)}")
+    jsonres = await res.json
+    assert 'cat' in jsonres['columns_infos']
+    assert jsonres['general_infos']['nb_columns'] == 2
+
+
 async def test_apify_analysed_csv_detective_check_format(rmock, csv_siren_siret, client):
     content = csv_siren_siret.replace('<sep>', ';').encode('utf-8')
     url = random_url()
@@ -643,3 +1546,12 @@ async def test_fail_one_line_json_file(rmock, one_line_json_file, client):
     rmock.get(url, body=content)
     res = await client.get(f"/apify?url={url}&analysis=yes")
     assert res.status_code == 500
+
+
+async def test_fail_binary_file(rmock, client):
+    url = random_url()
+    rmock.get(url, body=b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR')
+    res = await client.get(f"/apify?url={url}")
+    assert res.status_code == 500
+    jsonres = await res.json
+    assert 'Unsupported file type application/octet-stream' in jsonres['error']